@@ -1,35 +1,215 @@
 #!/usr/bin/env python3
 
+import glob
+import gzip
 import os
 import sys
-from collections import defaultdict
+from array import array
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from itertools import islice
+from multiprocessing import get_context
 from optparse import OptionParser
 from typing import Optional
 
+import numpy as np
+
+# ------------------------------------
+# Constants
+# ------------------------------------
+CHUNK_LINES = 100000  # lines annotated at one time
+CHUNK_CANDIDATES = 1000000  # candidate elements of regions expanded at one time
+
 
 # ------------------------------------
 # Classes
 # ------------------------------------
+class StringTable():
+    """Store each distinct string once & refer it by integer id"""
+
+    def __init__(self, strings=()):
+        self.strings = list(strings)
+        self.ids = {string: i for i, string in enumerate(self.strings)}
+        self._array = None
+
+    def get_id(self, string: str) -> int:
+        """Return id of string, add it to table if new"""
+
+        if string not in self.ids:
+            self.ids[string] = len(self.strings)
+            self.strings.append(string)
+            self._array = None
+        return self.ids[string]
+
+    def as_array(self):
+        """Strings as object array, for gathering names by id arrays"""
+
+        if self._array is None:
+            self._array = np.array(self.strings, dtype=object)
+        return self._array
+
+    def __getitem__(self, key):
+        return self.strings.__getitem__(key)
+
+    def __len__(self) -> int:
+        return self.strings.__len__()
+
+
 class Bed():
-    """Store region"""
+    """Store region
 
-    def __init__(self):
-        self.regions = defaultdict(list)
+Regions are stored as int32 start, end & name id columns per chromosome,
+names are kept once in name_table which can be shared between Beds.
+"""
+
+    def __init__(self, name_table: Optional[StringTable] = None):
+        self.name_table = StringTable() if name_table is None else name_table
+        self.columns = defaultdict(lambda: (array('i'), array('i'), array('i')))
+        self.index = {}
 
     def add_one_region(self, chrom: str, start: int, end: int,
                        name: str) -> None:
         """Add one region to Bed"""
 
-        self.regions[chrom].append((start, end, name))
+        starts, ends, name_ids = self.columns[chrom]
+        starts.append(start)
+        ends.append(end)
+        name_ids.append(self.name_table.get_id(name))
+
+    def build_index(self) -> None:
+        """Sort regions by start & build per chromosome arrays for overlap query"""
+
+        for chrom, columns in self.columns.items():
+            starts, ends, name_ids = (np.frombuffer(column, dtype=np.int32)
+                                      for column in columns)
+            order = np.argsort(starts, kind='stable')
+            self.set_chrom_index(chrom, starts[order], ends[order],
+                                 name_ids[order])
+        self.columns.clear()
+
+    def set_chrom_index(self, chrom: str, starts, ends, name_ids) -> None:
+        """Set index of one chromosome from start sorted arrays
+
+The index of each chromosome is (starts, ends, max_ends, name_ids), where
+max_ends is the running maximum of ends. Regions before the first max_end
+larger than query start can not overlap with the query.
+
+This is not an interval tree: a query costs O(log n) plus the regions between
+the first max_end larger than its start and its end, not only the overlapped
+ones. After a long region (e.g. a long intron) max_ends stays at its end, so
+queries up to that end scan every region starting after it.
+"""
+
+        self.index[chrom] = (starts, ends, np.maximum.accumulate(ends),
+                             name_ids)
+
+    def overlap_range(self, chrom: str, start: int, end: int) -> tuple:
+        """Return [lo, hi) index range of regions may overlap with start-end
+
+The range holds every overlapped region, but also regions ending before start
+when a longer region precedes them, see set_chrom_index.
+"""
+
+        starts, _, max_ends, _ = self.index[chrom]
+        lo = int(np.searchsorted(max_ends, start, side='right'))
+        hi = int(np.searchsorted(starts, end, side='left'))
+        return lo, hi
+
+    def get_regions(self, chrom: str, lo: int, hi: int) -> list:
+        """Return regions [lo, hi) of chrom as (start, end, name_id) tuples"""
+
+        starts, ends, _, name_ids = self.index[chrom]
+        return list(
+            zip(starts[lo:hi].tolist(), ends[lo:hi].tolist(),
+                name_ids[lo:hi].tolist()))
 
     def __contains__(self, chrom: str) -> bool:
-        return self.regions.__contains__(chrom)
+        return chrom in self.index or chrom in self.columns
 
     def items(self):
-        return self.regions.items()
+        for chrom in self.index:
+            yield chrom, self[chrom]
 
     def __getitem__(self, key):
-        return self.regions.__getitem__(key)
+        """Regions of chromosome key as (start, end, name) tuples"""
+
+        return [(start, end, self.name_table[name_id])
+                for start, end, name_id in self.get_regions(
+                    key, 0, len(self.index[key][0]))]
+
+
+class BedCursor():
+    """Sweep over one Bed with coordinate sorted queries"""
+
+    def __init__(self, bed: Bed):
+        self.bed = bed
+        self.chrom = None
+        self.pos = 0
+
+    def overlap_range(self, chrom: str, start: int, end: int) -> tuple:
+        """Same as Bed.overlap_range, queries must be sorted by chrom & start"""
+
+        if chrom != self.chrom:
+            self.chrom, self.pos = chrom, 0
+        starts, _, max_ends, _ = self.bed.index[chrom]
+        # regions before cursor end before current & following queries
+        self.pos += int(
+            np.searchsorted(max_ends[self.pos:], start, side='right'))
+        hi = self.pos + int(
+            np.searchsorted(starts[self.pos:], end, side='left'))
+        return self.pos, hi
+
+    def annotate(self, chrom: str, start: int, end: int):
+        """Annotate one region, queries must be sorted by chrom & start"""
+
+        if chrom not in self.bed:
+            return None
+        lo, hi = self.overlap_range(chrom, start, end)
+
+        return match_regions(start, end, self.bed, chrom, lo, hi)
+
+
+class TSSIndex():
+    """Sorted TSS positions per chromosome for nearest TSS query"""
+
+    def __init__(self, TSS: dict):
+        chrom_TSS = defaultdict(list)
+        for name, (chrom, tss) in TSS.items():
+            chrom_TSS[chrom].append((tss, name))
+        self.index = {}
+        for chrom, values in chrom_TSS.items():
+            values.sort()
+            self.index[chrom] = (np.array([tss for tss, _ in values],
+                                          dtype=np.int64),
+                                 np.array([name for _, name in values],
+                                          dtype=object))
+
+    def __contains__(self, chrom: str) -> bool:
+        return self.index.__contains__(chrom)
+
+    def nearest(self, chrom: str, starts, ends):
+        """Nearest TSS of regions on chrom
+
+Distance is from region center to TSS, same as distance of annotation. The
+upstream TSS is selected if two TSSs have the same distance.
+
+Returns
+----------
+name : object array
+distance : int array
+"""
+        positions, names = self.index[chrom]
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        right = np.minimum(np.searchsorted(positions, (starts + ends) >> 1),
+                           len(positions) - 1)
+        left = np.maximum(right - 1, 0)
+        left_distance = np.abs((starts + ends) - 2 * positions[left]) >> 1
+        right_distance = np.abs((starts + ends) - 2 * positions[right]) >> 1
+        use_left = left_distance <= right_distance
+        nearest = np.where(use_left, left, right)
+        return names[nearest], np.where(use_left, left_distance,
+                                        right_distance)
 
 
 # ------------------------------------
@@ -64,25 +244,161 @@ status: bool
 def region_annotate(bedRegion, elementRegion):
     """annotate one region for one element"""
 
-    match = None
     (chrom, start, end) = bedRegion
     if chrom not in elementRegion:
-        return match
-    for region in elementRegion[chrom]:
+        return None
+    lo, hi = elementRegion.overlap_range(chrom, start, end)
+
+    return match_regions(start, end, elementRegion, chrom, lo, hi)
+
+
+def match_regions(start: int, end: int, elementRegion, chrom: str, lo: int,
+                  hi: int):
+    """Select match from candidate regions [lo, hi) of chrom
+
+Returns
+----------
+match : list[distance, name] or None
+"""
+    match = None
+    for region in elementRegion.get_regions(chrom, lo, hi):
         if region[1] <= start:
             continue
-        if region[0] < end and region[1] > start:
-            match, status = match_comparsion(match, start, end, region)
-            if status:
-                break
-            else:
-                continue
-        if region[0] >= end:
+        match, status = match_comparsion(match, start, end, region)
+        if status:
             break
+    if match is not None:
+        match[1] = elementRegion.name_table[match[1]]
 
     return match
 
 
+@contextmanager
+def smart_open(file_name: str, mode: str = 'r'):
+    """Open file_name in text mode, - for stdin/stdout, .gz for gzip file"""
+
+    if file_name == '-':
+        fhd = sys.stdin if mode == 'r' else sys.stdout
+    elif file_name.endswith('.gz'):
+        fhd = gzip.open(file_name, f'{mode}t')
+    else:
+        fhd = open(file_name, mode)
+
+    try:
+        yield fhd
+    finally:
+        if fhd is sys.stdout:
+            fhd.flush()
+        elif fhd is not sys.stdin:
+            fhd.close()
+
+
+def output_file_name_of(bed_file: str) -> str:
+    """Default output file name of bed_file, gzip output for gzip input"""
+
+    if bed_file == '-':
+        return '-'
+    if bed_file.endswith('.gz'):
+        return f'{bed_file[:-3].rsplit(".", 1)[0]}_annotation.txt.gz'
+    return f'{bed_file.rsplit(".", 1)[0]}_annotation.txt'
+
+
+def summary_file_name_of(output_file_name: str) -> str:
+    """Summary file name of output_file_name, None for stdout output"""
+
+    if output_file_name == '-':
+        return None
+    base_name = output_file_name
+    for suffix in ['.gz', '.txt']:
+        if base_name.endswith(suffix):
+            base_name = base_name[:-len(suffix)]
+    return f'{base_name}_summary.txt'
+
+
+def overlap_regions(start: int, end: int, elementRegion, chrom: str, lo: int,
+                    hi: int) -> list:
+    """All overlapped regions of candidate regions [lo, hi) of chrom
+
+Returns
+----------
+matches : list[list[distance, name]]
+"""
+    return [[
+        abs((start + end) - (region[0] + region[1])) >> 1,
+        elementRegion.name_table[region[2]]
+    ] for region in elementRegion.get_regions(chrom, lo, hi)
+            if region[1] > start]
+
+
+def _chrom_candidates(starts, ends, lo, counts, r_starts, r_ends):
+    """selected candidate of each query with candidates [lo, lo + counts)
+
+Returns
+----------
+query : int array, index of queries with a match
+candidate : int array, index of matched element
+dist : int array
+"""
+    # expand every query to its candidate elements, keep overlapped ones
+    query = np.repeat(np.arange(len(starts)), counts)
+    offsets = np.arange(len(query)) - np.repeat(np.cumsum(counts) - counts,
+                                                counts)
+    candidate = np.repeat(lo, counts) + offsets
+    overlap = r_ends[candidate] > starts[query]
+    query, candidate = query[overlap], candidate[overlap]
+    if len(query) == 0:
+        return query, candidate, query
+    dist = np.abs((starts[query] + ends[query]) -
+                  (r_starts[candidate] + r_ends[candidate])) >> 1
+
+    # selected element: followed by a farther one or the last of its query
+    same_query = query[1:] == query[:-1]
+    stop = np.ones(len(query), dtype=bool)
+    stop[:-1] = ~same_query | (dist[1:] > dist[:-1])
+    stop_pos = np.flatnonzero(stop)
+    _, first = np.unique(query[stop_pos], return_index=True)
+    selected = stop_pos[first]
+    return query[selected], candidate[selected], dist[selected]
+
+
+def chrom_annotate(chrom: str, starts, ends, elementRegion):
+    """annotate regions of one chromosome for one element at once
+
+Same match rule as region_annotate: overlapped elements are visited in order
+and the last one before distance increasing is selected. Queries are
+expanded to candidates in batches of about CHUNK_CANDIDATES candidates.
+
+Returns
+----------
+hit : bool array, whether the region has a match
+index : int array, index of matched element in elementRegion[chrom]
+distance : int array
+"""
+    hit = np.zeros(len(starts), dtype=bool)
+    index = np.zeros(len(starts), dtype=np.int64)
+    distance = np.zeros(len(starts), dtype=np.int64)
+    if chrom not in elementRegion or len(starts) == 0:
+        return hit, index, distance
+    r_starts, r_ends, max_ends, _ = elementRegion.index[chrom]
+    lo = np.searchsorted(max_ends, starts, side='right')
+    hi = np.searchsorted(r_starts, ends, side='left')
+    counts = np.maximum(hi - lo, 0)
+
+    # a batch ends where the candidates before a query cross a multiple of
+    # CHUNK_CANDIDATES, only a query with more candidates exceeds it
+    batch = (np.cumsum(counts) - counts) // CHUNK_CANDIDATES
+    bounds = np.concatenate([[0], np.flatnonzero(batch[1:] != batch[:-1]) + 1,
+                             [len(starts)]])
+    for begin, end in zip(bounds[:-1], bounds[1:]):
+        query, candidate, dist = _chrom_candidates(
+            starts[begin:end], ends[begin:end], lo[begin:end],
+            counts[begin:end], r_starts, r_ends)
+        hit[begin + query] = True
+        index[begin + query] = candidate
+        distance[begin + query] = dist
+    return hit, index, distance
+
+
 # ------------------------------------
 # Sub Functions
 # ------------------------------------
@@ -91,8 +407,8 @@ def prepare_optparser():
     Prepare optparser object. New options will be added in thisfunction first.
     """
 
-    usage = "USAGE: %prog <-b bed> <-a annotation> [-f annotation_format] [-p promoter] [-e enhancer] [--name2]"
-    description = "BedAnnotation -- Annotate a bed file."
+    usage = "USAGE: %prog <-b bed+> <-a annotation> [-o output+] [--bed-list bed_list] [-f annotation_format] [-p promoter] [-e enhancer] [--name2] [--sorted] [--no-cache] [-P processes] [--report best|all|nearest] [--summary]"
+    description = "BedAnnotation -- Annotate bed file(s)."
 
     # option processor
     optparser = OptionParser(version="%prog 0.1",
@@ -107,11 +423,26 @@ def prepare_optparser():
                          help="Show this help message and exit.")
 
     # input options
-    optparser.add_option("-b",
-                         "--bed",
-                         dest="bed",
-                         type="string",
-                         help="Bed file to be annotated.")
+    optparser.add_option(
+        "-b",
+        "--bed",
+        dest="bed",
+        type="string",
+        action="append",
+        help="Bed file(s) to be annotated. Can be given multiple times or as a quoted glob pattern. Can be gzip file (.gz) or - for stdin.")
+    optparser.add_option(
+        "--bed-list",
+        dest="bed_list",
+        type="string",
+        help="File of bed files to be annotated, one per line.")
+    optparser.add_option(
+        "-o",
+        "--output",
+        dest="output",
+        type="string",
+        action="append",
+        help="Output file(s), one for each bed file. Gzip output if end with .gz, - for stdout. Default is <bed>_annotation.txt(.gz), or stdout if bed is stdin."
+    )
     optparser.add_option("-a",
                          "--ann",
                          dest="ann",
@@ -147,6 +478,39 @@ def prepare_optparser():
         action="store_true",
         help="Whether use name2 for annotation. Only support refGene format now. Default is flase."
     )
+    optparser.add_option(
+        "--sorted",
+        dest="sorted",
+        action="store_true",
+        help="Input bed file is sorted by chrom & start (sort -k1,1 -k2,2n). Annotate in one linear sweep. Default is false."
+    )
+    optparser.add_option(
+        "--report",
+        dest="report",
+        type="choice",
+        choices=['best', 'all', 'nearest'],
+        help="best: report the closest element of the first overlapped class. all: report every overlapped element of every class, one per line. nearest: as best, and report the nearest TSS for intergenic regions. Default is best.",
+        default="best")
+    optparser.add_option(
+        "--summary",
+        dest="summary",
+        action="store_true",
+        help="Also write number & bp of regions annotated as each element class to <output>_summary.txt (stderr if output is stdout). Regions are counted by their first class. Default is false."
+    )
+    optparser.add_option(
+        "-P",
+        "--processes",
+        dest="processes",
+        type="int",
+        help="Number of processes for annotation. Default is 1.",
+        default=1)
+    optparser.add_option(
+        "--no-cache",
+        dest="cache",
+        action="store_false",
+        default=True,
+        help="Do not use or write the cached annotation index (<annotation>.<setting>.npz). Default is use cache."
+    )
 
     return optparser
 
@@ -160,13 +524,54 @@ def opt_validate(optparser):
     (options, args) = optparser.parse_args()
 
     # input bed and anntation file must be given
-    if not (options.bed and options.ann):
+    if not ((options.bed or options.bed_list) and options.ann):
         sys.stdout.write("Input bed and anntation file must be given!\n")
         optparser.print_help()
         sys.exit(1)
 
-    if not os.path.isfile(options.bed):
-        sys.stdout.write("Can not find bed file: {}.\n".format(options.bed))
+    # expand glob patterns & bed list
+    bed_files = []
+    for bed_file in options.bed or []:
+        if glob.has_magic(bed_file):
+            matched_files = sorted(glob.glob(bed_file))
+            if not matched_files:
+                sys.stdout.write(
+                    "Can not find bed file matching: {}.\n".format(bed_file))
+                optparser.print_help()
+                sys.exit(1)
+            bed_files.extend(matched_files)
+        else:
+            bed_files.append(bed_file)
+    if options.bed_list:
+        if not os.path.isfile(options.bed_list):
+            sys.stdout.write("Can not find bed list file: {}.\n".format(
+                options.bed_list))
+            optparser.print_help()
+            sys.exit(1)
+        with open(options.bed_list) as fhd:
+            bed_files.extend(line.strip() for line in fhd if line.strip())
+    options.bed = bed_files
+
+    if '-' in options.bed and len(options.bed) > 1:
+        sys.stdout.write("Stdin can not be used with other bed files.\n")
+        optparser.print_help()
+        sys.exit(1)
+
+    for bed_file in options.bed:
+        if bed_file != '-' and not os.path.isfile(bed_file):
+            sys.stdout.write("Can not find bed file: {}.\n".format(bed_file))
+            optparser.print_help()
+            sys.exit(1)
+
+    # output name
+    if not options.output:
+        options.output = [
+            output_file_name_of(bed_file) for bed_file in options.bed
+        ]
+    elif len(options.output) != len(options.bed):
+        sys.stdout.write(
+            "The number of input bed files and number of output files are not equal!\n"
+        )
         optparser.print_help()
         sys.exit(1)
 
@@ -176,6 +581,11 @@ def opt_validate(optparser):
         optparser.print_help()
         sys.exit(1)
 
+    if options.processes < 1:
+        sys.stdout.write("Number of processes must be positive.\n")
+        optparser.print_help()
+        sys.exit(1)
+
     # validate promoter and enhancer range
     if options.enhancer != 0:
         if options.enhancer <= options.promoter:
@@ -187,10 +597,118 @@ def opt_validate(optparser):
     return options
 
 
-def load_annotation(anntation, format, promoter, enhancer, name2):
-    """Load anntation file & return annotationRegion, TSS"""
-    promoterRegion, exonRegion, intronRegion, enhancerRegion = Bed(), Bed(
-    ), Bed(), Bed()
+def annotation_cache_file(anntation, format, promoter, enhancer, name2):
+    """Cache file name of one annotation setting"""
+
+    name2_label = '_name2' if name2 else ''
+    return f'{anntation}.{format}_p{promoter}_e{enhancer}{name2_label}.npz'
+
+
+def annotation_signature(anntation):
+    """Size & modify time of annotation file, cache is stale if changed"""
+
+    stat = os.stat(anntation)
+    return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+
+def save_annotation_cache(cache_file, signature, annotationRegion, TSS):
+    """Save annotationRegion & TSS as arrays, names are stored in one table"""
+
+    name_table = annotationRegion['promoter'].name_table
+    chrom_table = sorted({chrom for chrom, _ in TSS.values()}.union(
+        *[elementRegion.index for elementRegion in annotationRegion.values()]))
+    chrom_ids = {chrom: i for i, chrom in enumerate(chrom_table)}
+    arrays = {
+        'signature': signature,
+        'name_table': np.array(name_table.strings, dtype=str),
+        'chrom_table': np.array(chrom_table, dtype=str),
+        'tss_name': np.array([name_table.ids[name] for name in TSS],
+                             dtype=np.int32),
+        'tss_chrom': np.array([chrom_ids[chrom] for chrom, _ in TSS.values()],
+                              dtype=np.int32),
+        'tss_pos': np.array([pos for _, pos in TSS.values()], dtype=np.int64)
+    }
+    for label, elementRegion in annotationRegion.items():
+        for chrom, (starts, ends, _, name_ids) in elementRegion.index.items():
+            key = f'{label}_{chrom_ids[chrom]}'
+            arrays[f'{key}_starts'] = starts
+            arrays[f'{key}_ends'] = ends
+            arrays[f'{key}_names'] = name_ids
+
+    # write to a temp file first, other runs never see a partial cache
+    temp_file = f'{cache_file}.{os.getpid()}.tmp'
+    try:
+        with open(temp_file, 'wb') as fhd:
+            np.savez(fhd, **arrays)
+        os.replace(temp_file, cache_file)
+    except OSError:  # annotation directory is not writable, skip caching
+        if os.path.isfile(temp_file):
+            os.remove(temp_file)
+
+
+def load_annotation_cache(cache_file, signature):
+    """Load annotationRegion & TSS from cache, None if missing or stale"""
+
+    if not os.path.isfile(cache_file):
+        return None
+    with np.load(cache_file) as arrays:
+        if not np.array_equal(arrays['signature'], signature):
+            return None
+        name_table = StringTable(arrays['name_table'].tolist())
+        chrom_table = arrays['chrom_table'].tolist()
+        annotationRegion = {
+            label: Bed(name_table)
+            for label in ['promoter', 'exon', 'intron', 'enhancer']
+        }
+        for label, elementRegion in annotationRegion.items():
+            for i, chrom in enumerate(chrom_table):
+                key = f'{label}_{i}'
+                if f'{key}_starts' not in arrays:
+                    continue
+                elementRegion.set_chrom_index(chrom, arrays[f'{key}_starts'],
+                                              arrays[f'{key}_ends'],
+                                              arrays[f'{key}_names'])
+        TSS = {
+            name_table[name]: (chrom_table[chrom], pos)
+            for name, chrom, pos in zip(arrays['tss_name'].tolist(),
+                                        arrays['tss_chrom'].tolist(),
+                                        arrays['tss_pos'].tolist())
+        }
+
+    return (annotationRegion, TSS)
+
+
+def load_annotation(anntation,
+                    format,
+                    promoter,
+                    enhancer,
+                    name2,
+                    cache=True):
+    """Load anntation file & return annotationRegion, TSS
+
+Result of each setting is cached next to anntation file & reused until the
+anntation file is changed. Set cache to False to always parse anntation file.
+"""
+    if cache:
+        cache_file = annotation_cache_file(anntation, format, promoter,
+                                           enhancer, name2)
+        signature = annotation_signature(anntation)
+        cached = load_annotation_cache(cache_file, signature)
+        if cached is not None:
+            return cached
+    (annotationRegion, TSS) = parse_annotation(anntation, format, promoter,
+                                               enhancer, name2)
+    if cache:
+        save_annotation_cache(cache_file, signature, annotationRegion, TSS)
+
+    return (annotationRegion, TSS)
+
+
+def parse_annotation(anntation, format, promoter, enhancer, name2):
+    """Parse anntation file & return annotationRegion, TSS"""
+    name_table = StringTable()
+    promoterRegion, exonRegion, intronRegion, enhancerRegion = Bed(
+        name_table), Bed(name_table), Bed(name_table), Bed(name_table)
     annotationRegion = {
         "promoter": promoterRegion,
         "exon": exonRegion,
@@ -299,13 +817,319 @@ def load_annotation(anntation, format, promoter, enhancer, name2):
                                           tss + enhancer, name)
 
     for label in annotationRegion:
-        for chrom, values in annotationRegion[label].items():
-            values.sort(key=lambda x: x[0])
+        annotationRegion[label].build_index()
     annFhd.close()
 
     return (annotationRegion, TSS)
 
 
+def check_sorted(chrom, start, sort_state, line):
+    """Raise ValueError if a line is not sorted after lines checked before
+
+sort_state : [last chrom, last start, finished chroms], updated in place, so
+        the order is checked across chunks of a file.
+"""
+
+    last_chrom, last_start, finished_chroms = sort_state
+    if chrom != last_chrom:
+        finished_chroms.add(last_chrom)
+        last_start = start
+    if chrom in finished_chroms or start < last_start:
+        raise ValueError(f"Bed file is not sorted at line: {line}")
+    sort_state[0], sort_state[1] = chrom, start
+
+
+def annotate_lines(lines,
+                   annotationRegion,
+                   sorted_input=False,
+                   report='best',
+                   tssIndex=None,
+                   summary=None,
+                   sort_state=None):
+    """Annotate bed lines & return output text
+
+report : best, all or nearest
+        best: the closest element of the first element class overlapped.
+        all: one output line for every overlapped element of every class.
+        nearest: same as best, intergenic regions are given the nearest TSS
+                 from tssIndex.
+summary : dict, optional
+        {element: [region number, bp]}, updated by the first element class
+        of each annotated region.
+sort_state : list, optional
+        order of lines checked before, see check_sorted.
+
+Raise ValueError if sorted_input is set but lines are not sorted.
+"""
+
+    no_match_info = '\tintergenic\tNA\tNA\n'
+    elsments_priority = ['promoter', 'exon', 'intron', 'enhancer']
+    if sorted_input:
+        cursors = {
+            element: BedCursor(annotationRegion[element])
+            for element in elsments_priority
+        }
+        if sort_state is None:
+            sort_state = [None, 0, set()]
+
+    output = []
+    for line in lines:
+        new_line = line.strip()
+        chrom, start, end, *_ = line.strip().split()
+        start, end = int(start), int(end)
+        if sorted_input:
+            check_sorted(chrom, start, sort_state, new_line)
+        if chrom not in annotationRegion['promoter']:
+            new_line += no_match_info
+            continue
+        primary = None
+        for element in elsments_priority:
+            elementRegion = annotationRegion[element]
+            if chrom not in elementRegion:
+                continue
+            if sorted_input:
+                lo, hi = cursors[element].overlap_range(chrom, start, end)
+            else:
+                lo, hi = elementRegion.overlap_range(chrom, start, end)
+            if report == 'all':
+                for match in overlap_regions(start, end, elementRegion, chrom,
+                                             lo, hi):
+                    output.append(
+                        f'{new_line}\t{element}\t{match[1]:s}\t{match[0]:d}\n'
+                    )
+                    primary = primary or element
+                continue
+            match = match_regions(start, end, elementRegion, chrom, lo, hi)
+            if match is not None:
+                output.append(
+                    f'{new_line}\t{element}\t{match[1]:s}\t{match[0]:d}\n')
+                primary = element
+                break
+        if summary is not None:
+            summary[primary or 'intergenic'][0] += 1
+            summary[primary or 'intergenic'][1] += end - start
+        if primary is not None:
+            continue
+        if report == 'nearest' and chrom in tssIndex:
+            names, distances = tssIndex.nearest(chrom, [start], [end])
+            output.append(
+                f'{new_line}\tintergenic\t{names[0]:s}\t{distances[0]:d}\n')
+        else:
+            output.append(new_line + no_match_info)
+
+    return ''.join(output)
+
+
+def chunk_gen(fhd, chunk_size=CHUNK_LINES):
+    """Yield lines of fhd in chunks"""
+
+    while True:
+        chunk = list(islice(fhd, chunk_size))
+        if not chunk:
+            break
+        yield chunk
+
+
+# annotation shared with forked worker processes (copy-on-write)
+_worker_annotation = None
+
+
+def _annotate_chunk(lines, sorted_input, report):
+    annotationRegion, tssIndex = _worker_annotation
+    summary = new_summary()
+    output = annotate_lines(lines, annotationRegion, sorted_input, report,
+                            tssIndex, summary)
+    return output, summary
+
+
+def new_summary() -> dict:
+    """Empty {element: [region number, bp]} summary"""
+
+    return {
+        element: [0, 0]
+        for element in
+        ['promoter', 'exon', 'intron', 'enhancer', 'intergenic']
+    }
+
+
+def merge_summary(summary: dict, other: dict) -> None:
+    """Add counts of other summary to summary"""
+
+    for element, (number, bp) in other.items():
+        summary[element][0] += number
+        summary[element][1] += bp
+
+
+def write_summary(summary: dict, fhd) -> None:
+    """Write region number, bp & fractions of each element class as tsv"""
+
+    total_number = sum(number for number, _ in summary.values())
+    total_bp = sum(bp for _, bp in summary.values())
+    fhd.write('element\tregions\tregion_fraction\tbp\tbp_fraction\n')
+    for element, (number, bp) in summary.items():
+        number_fraction = number / total_number if total_number else 0
+        bp_fraction = bp / total_bp if total_bp else 0
+        fhd.write(f'{element}\t{number:d}\t{number_fraction:.4f}\t'
+                  f'{bp:d}\t{bp_fraction:.4f}\n')
+
+
+def write_chunk(output_fhd, result, summary):
+    """Write result of _annotate_chunk & merge its summary"""
+
+    output, chunk_summary = result.get()
+    output_fhd.write(output)
+    if summary is not None:
+        merge_summary(summary, chunk_summary)
+
+
+def annotate_file(bed_file,
+                  output_file_name,
+                  annotationRegion,
+                  sorted_input,
+                  processes=1,
+                  report='best',
+                  tssIndex=None,
+                  summary=None):
+    """Annotate each line of bed_file & write to output_file_name
+
+Input is annotated in chunks of lines. With more than one process, chunks are
+sent to forked workers sharing annotationRegion, and outputs are written in
+the original order. summary is updated as in annotate_lines if given.
+
+Raise ValueError if sorted_input is set but bed_file is not sorted. The order
+is checked across chunks, before chunks are sent to workers.
+"""
+    global _worker_annotation
+
+    sort_state = [None, 0, set()]
+    with smart_open(bed_file) as bed_fhd, \
+         smart_open(output_file_name, 'w') as output_fhd:
+        if processes == 1:
+            for chunk in chunk_gen(bed_fhd):
+                output_fhd.write(
+                    annotate_lines(chunk, annotationRegion, sorted_input,
+                                   report, tssIndex, summary, sort_state))
+            return
+        _worker_annotation = (annotationRegion, tssIndex)
+        with get_context('fork').Pool(processes) as pool:
+            pending = deque()
+            for chunk in chunk_gen(bed_fhd):
+                if sorted_input:
+                    for line in chunk:
+                        chrom, start, *_ = line.split()
+                        check_sorted(chrom, int(start), sort_state,
+                                     line.strip())
+                pending.append(
+                    pool.apply_async(_annotate_chunk,
+                                     (chunk, sorted_input, report)))
+                # limit chunks in flight, keep memory bounded
+                if len(pending) >= processes * 2:
+                    write_chunk(output_fhd, pending.popleft(), summary)
+            while pending:
+                write_chunk(output_fhd, pending.popleft(), summary)
+
+
+def annotate_one_file(bed_file, output_file_name, annotationRegion, options,
+                      tssIndex, processes):
+    """Annotate one bed file & write its summary if options.summary is set"""
+
+    summary = new_summary() if options.summary else None
+    annotate_file(bed_file, output_file_name, annotationRegion,
+                  options.sorted, processes, options.report, tssIndex,
+                  summary)
+    if options.summary:
+        summary_file_name = summary_file_name_of(output_file_name)
+        if summary_file_name is None:
+            write_summary(summary, sys.stderr)
+        else:
+            with smart_open(summary_file_name, 'w') as summary_fhd:
+                write_summary(summary, summary_fhd)
+
+
+def _annotate_one_file(bed_file, output_file_name, options):
+    annotationRegion, tssIndex = _worker_annotation
+    annotate_one_file(bed_file, output_file_name, annotationRegion, options,
+                      tssIndex, 1)
+    return bed_file
+
+
+def annotate_files(bed_files, output_file_names, annotationRegion, options,
+                   tssIndex):
+    """Annotate bed files with one loaded annotation
+
+With one bed file, or only one process, files are annotated one by one and
+chunks of each file are shared by processes. Otherwise each forked worker
+annotates whole files.
+"""
+    global _worker_annotation
+
+    if len(bed_files) == 1 or options.processes == 1:
+        for bed_file, output_file_name in zip(bed_files, output_file_names):
+            annotate_one_file(bed_file, output_file_name, annotationRegion,
+                              options, tssIndex, options.processes)
+        return
+    _worker_annotation = (annotationRegion, tssIndex)
+    with get_context('fork').Pool(min(options.processes,
+                                      len(bed_files))) as pool:
+        results = [
+            pool.apply_async(_annotate_one_file,
+                             (bed_file, output_file_name, options))
+            for bed_file, output_file_name in zip(bed_files,
+                                                  output_file_names)
+        ]
+        for result in results:
+            result.get()
+
+
+def annotate_regions(chroms, starts, ends, annotationRegion, tssIndex=None):
+    """Annotate regions in batch, for in memory usage
+
+Parameters
+----------
+chroms : array-like of str
+starts : array-like of int
+ends : array-like of int
+annotationRegion : dict, first element returned by load_annotation
+tssIndex : TSSIndex, optional
+        If given, intergenic regions are given the nearest TSS.
+
+Returns
+----------
+element : str array, promoter, exon, intron, enhancer or intergenic
+name : object array, None for intergenic regions without nearest TSS
+distance : int array, -1 for intergenic regions without nearest TSS
+"""
+    chroms = np.asarray(chroms)
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    elsments_priority = ['promoter', 'exon', 'intron', 'enhancer']
+    element = np.full(len(chroms), 'intergenic', dtype='U10')
+    name = np.full(len(chroms), None, dtype=object)
+    distance = np.full(len(chroms), -1, dtype=np.int64)
+
+    for chrom in np.unique(chroms):
+        todo = np.flatnonzero(chroms == chrom)
+        for label in elsments_priority:
+            if len(todo) == 0:
+                break
+            hit, index, dist = chrom_annotate(chrom, starts[todo], ends[todo],
+                                              annotationRegion[label])
+            if not hit.any():
+                continue
+            rows = todo[hit]
+            element[rows] = label
+            elementRegion = annotationRegion[label]
+            name[rows] = elementRegion.name_table.as_array()[
+                elementRegion.index[chrom][3][index[hit]]]
+            distance[rows] = dist[hit]
+            todo = todo[~hit]
+        if tssIndex is not None and len(todo) and chrom in tssIndex:
+            name[todo], distance[todo] = tssIndex.nearest(
+                chrom, starts[todo], ends[todo])
+
+    return element, name, distance
+
+
 # ------------------------------------
 # Main function
 # ------------------------------------
@@ -315,33 +1139,19 @@ def main():
     options = opt_validate(prepare_optparser())
 
     # load annotation information & TSS
-    (annotationRegion, _) = load_annotation(options.ann, options.format,
-                                            options.promoter, options.enhancer,
-                                            options.name2)
+    (annotationRegion, TSS) = load_annotation(options.ann, options.format,
+                                              options.promoter,
+                                              options.enhancer, options.name2,
+                                              options.cache)
+    tssIndex = TSSIndex(TSS) if options.report == 'nearest' else None
 
     # do annotation
-    output_file_name = f'{options.bed.rsplit(".", 1)[0]}_annotation.txt'
-    no_match_info = '\tintergenic\tNA\tNA\n'
-    elsments_priority = ['promoter', 'exon', 'intron', 'enhancer']
-
-    with open(options.bed) as bed_fhd, \
-         open(output_file_name, 'w') as output_fhd:
-        for line in bed_fhd:
-            new_line = line.strip()
-            chrom, start, end, *_ = line.strip().split()
-            start, end = int(start), int(end)
-            if chrom not in annotationRegion['promoter']:
-                new_line += no_match_info
-                continue
-            for element in elsments_priority:
-                match = region_annotate((chrom, start, end),
-                                        annotationRegion[element])
-                if match is not None:
-                    new_line += f'\t{element}\t{match[1]:s}\t{match[0]:d}\n'
-                    break
-            else:
-                new_line += no_match_info
-            output_fhd.write(new_line)
+    try:
+        annotate_files(options.bed, options.output, annotationRegion, options,
+                       tssIndex)
+    except ValueError as error:
+        sys.stderr.write(f"{error}\n")
+        sys.exit(1)
 
 
 # ------------------------------------
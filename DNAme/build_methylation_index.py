@@ -0,0 +1,85 @@
+#! /usr/bin/env python3
+
+# Build binary methylation index used by DNAme scripts.
+
+import os
+import sys
+from optparse import OptionParser
+from methylation_store import build_index, index_dir_of, index_is_fresh
+
+
+# ------------------------------------
+# Sub Functions
+# ------------------------------------
+def prepare_optparser():
+    
+    '''Prepare optparser object. New options will be added in this
+    function first.
+    '''
+    
+    program_name = os.path.basename(sys.argv[0])
+    usage = 'usage: %prog <-m meth_file+> [-f]'
+    description = 'Convert methylation info file(s) (mcall XX.bam.G.bed) to binary index (XX.bam.G.bed.index), which is used by DNAme scripts instead of the text file once it is newer than the text file.'
+    
+    # option processor
+    optparser = OptionParser(version='%prog 0.1', description=description, usage=usage, add_help_option=False)
+    optparser.add_option('-h','--help', action='help', help='Show this help message and exit.')
+    optparser.add_option('-m','--meth', dest='meth', type='string', action='append',\
+                         help='Methylation info file(s).')
+    optparser.add_option('-f','--force', dest='force', action='store_true',\
+                         help='Rebuild index even if it is newer than methylation info file.')
+    return optparser
+
+
+def opt_validate(optparser):
+    
+    """Validate options from a OptParser object.
+    Ret: Validated options object.
+    """
+    
+    (options, args) = optparser.parse_args()
+    
+    # input methylation info file(s) must be given
+    if not options.meth:
+        sys.stdout.write('Input methylation info file(s) must be given!\n')
+        optparser.print_help()
+        sys.exit(1)
+    for meth_file in options.meth:
+        if not os.path.isfile(meth_file):
+            sys.stdout.write(f'Input methylation info file: {meth_file} can not be found!\n')
+            optparser.print_help()
+            sys.exit(1)
+    
+    return options
+
+
+# ------------------------------------
+# Main function
+# ------------------------------------
+def main():
+    
+    # read the options
+    options = opt_validate(prepare_optparser())
+    
+    # build index of each methylation info file
+    for meth_file in options.meth:
+        if not options.force and index_is_fresh(meth_file):
+            sys.stdout.write(f'Index of {meth_file} is up to date: {index_dir_of(meth_file)}\n')
+            continue
+        try:
+            index_dir = build_index(meth_file)
+        except ValueError as error:
+            sys.stdout.write(f'{error}\n')
+            sys.exit(1)
+        sys.stdout.write(f'Index of {meth_file} is built: {index_dir}\n')
+
+
+# ------------------------------------
+# Program running
+# ------------------------------------
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        sys.stdout.write('User interrupts me! ;-) See you ^.^!\n')
+        sys.exit(0)
@@ -6,9 +6,12 @@ import os
 import sys
 import csv
 from optparse import OptionParser
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
 import numpy as np
 from collections import defaultdict
 from contextlib import contextmanager
+from methylation_store import load_meth, sliding_windows, reduce_windows
 
 
 # ------------------------------------
@@ -21,14 +24,14 @@ def prepare_optparser():
     '''
     
     program_name = os.path.basename(sys.argv[0])
-    usage = 'usage: %prog <-m meth_file> <-b bed_file> [-o output_name] [-c coverage] [-w window] [-s step]'
+    usage = 'usage: %prog <-m meth_file+> <-b bed_file> [-o output_name] [-c coverage] [-w window] [-s step] [-P processes]'
     description = 'Get DNA methylation level (CpG) over regions.'
     
     # option processor
     optparser = OptionParser(version='%prog 0.1', description=description, usage=usage, add_help_option=False)
     optparser.add_option('-h','--help', action='help', help='Show this help message and exit.')
-    optparser.add_option('-m','--meth', dest='meth', type='string',\
-                         help='Methylation info file.')
+    optparser.add_option('-m','--meth', dest='meth', type='string', action='append',\
+                         help='Methylation info file(s). If more than one is given, levels of all samples are written to one regions x samples matrix for each bed file.')
     optparser.add_option('-b','--bed',dest='bed',type='string', action='append',\
                          help='Bed file(s) for regions to be capture.')
     optparser.add_option('-o','--output',dest='output',type='string', action='append',\
@@ -39,6 +42,8 @@ def prepare_optparser():
                          help='Sliding window size. Use the whole region if not set.')
     optparser.add_option('-s','--step',dest='step',type='int',\
                          help='Step for sliding window. Required when -w is set. Ignored if -w not set.')
+    optparser.add_option('-P','--processes',dest='processes',type='int',\
+                         help='Number of samples to load and process in parallel. Default is 1.', default=1)
     return optparser
 
 
@@ -50,13 +55,18 @@ def opt_validate(optparser):
     
     (options, args) = optparser.parse_args()
     
-    # input methylation info file must be given
+    # input methylation info file(s) must be given
     if not options.meth:
         sys.stdout.write('Input methylation info file must be given!\n')
         optparser.print_help()
         sys.exit(1)
-    if not os.path.isfile(options.meth):
-        sys.stdout.write(f'Input methylation info file: {options.meth} can not be found!\n')
+    for meth_file in options.meth:
+        if not os.path.isfile(meth_file):
+            sys.stdout.write(f'Input methylation info file: {meth_file} can not be found!\n')
+            optparser.print_help()
+            sys.exit(1)
+    if options.processes < 1:
+        sys.stdout.write('Processes must be positive!\n')
         optparser.print_help()
         sys.exit(1)
     
@@ -78,8 +88,10 @@ def opt_validate(optparser):
         sys.stdout.write(f'Warning: -s step is set but -w window not set, ignored.\n')
     
     # output name
-    if not options.output:
-        meth_name = options.meth.split('.')[0]
+    if not options.output and len(options.meth) > 1:
+        options.output = [f'{bed_file[:-3]}_methylation_level_matrix.csv' for bed_file in options.bed]
+    elif not options.output:
+        meth_name = options.meth[0].split('.')[0]
         options.output = [f'{bed_file[:-3]}_{meth_name}_methylation_level.csv' for bed_file in options.bed]
     elif len(options.output) != len(options.bed):
         sys.stdout.write('The number of input bed files and number of output files are not equal!\n')
@@ -89,43 +101,53 @@ def opt_validate(optparser):
     return options
 
 
-def load_meth(meth_file):
-    methylation = defaultdict(dict)
-    # {chrom: pos: {(ratio,totalC,methC)}}
-    with open(meth_file) as fhd:
-        for line in fhd:
-            if line[0] == '#' or not line:
-                continue
-            line = line.strip().split()
-            if len(line) < 15: # handle extra line in the bottom of XX.bam.G.bed
-                continue
-            methylation[line[0]][int(line[1])] = (float(line[3]), int(line[4]), int(line[5]))
-    return methylation
-
-
 def _get_avg_meth_over_region(region, methylation, coverage):
+    '''
+    Mean ratio of CpGs with coverage, start & end can be arrays of windows.
+    Sums are differences of float64 prefix sums, so a mean at a rounding tie
+    may differ from np.nanmean in the last printed digit.
+    '''
     (chrom, start, end) = region
-    window_methylation = []
-    for pos in range(start-1,end):
-        if (not pos in methylation[chrom]) or methylation[chrom][pos][1] < coverage:
-            continue
-        window_methylation.append(methylation[chrom][pos][0])
-    return np.nanmean(window_methylation)
+    covered = lambda ratio, total, meth: (total >= coverage) & ~np.isnan(ratio)
+    n = methylation.window_sum(chrom, start-1, end, f'covered_{coverage}', covered)
+    ratio_sum = methylation.window_sum(chrom, start-1, end, f'ratio_{coverage}',
+                                       lambda ratio, total, meth: np.where(covered(ratio, total, meth), ratio, 0))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(n > 0, ratio_sum / n, np.nan)
 
 
-def get_region_meth(region, methylation, coverage, options):
+def region_windows(regions, options):
     '''
+    Windows of regions of each chrom, which are the same for all samples, as
+    {chrom: (index, window_starts, window_ends, counts)}. index is rows of
+    regions, counts is None without -w & -s, where each region is a window.
     '''
-    (chrom, start, end) = region
-    region_methylation = []
-    if options.window and options.step:
-        for i in range((end - start - options.window) // options.step):
-            _start = start + i * options.step
-            _end = _start + options.window
-            region_methylation.append(_get_avg_meth_over_region((chrom, _start, _end), methylation, coverage))
-        return np.nanmin(region_methylation) if region_methylation else np.nan
-    else:
-        return _get_avg_meth_over_region(region, methylation, coverage)
+    chrom_index = defaultdict(list)
+    for i, region in enumerate(regions):
+        chrom_index[region[0]].append(i)
+    windows = {}
+    for chrom, index in chrom_index.items():
+        starts = np.array([regions[i][1] for i in index], dtype=np.int64)
+        ends = np.array([regions[i][2] for i in index], dtype=np.int64)
+        if options.window and options.step:
+            window_starts, counts = sliding_windows(starts, ends, options.window, options.step)
+            windows[chrom] = (index, window_starts, window_starts + options.window, counts)
+        else:
+            windows[chrom] = (index, starts, ends, None)
+    return windows
+
+
+def get_regions_meth(windows, region_number, methylation, coverage):
+    '''
+    Methylation level of regions of one sample, all windows of each chrom are
+    computed at once. With -w & -s, the level of a region is the minimum of
+    its sliding windows.
+    '''
+    values = np.zeros(region_number)
+    for chrom, (index, starts, ends, counts) in windows.items():
+        window_values = _get_avg_meth_over_region((chrom, starts, ends), methylation, coverage)
+        values[index] = window_values if counts is None else reduce_windows(np.fmin, window_values, counts)
+    return values
 
 
 @contextmanager
@@ -135,12 +157,10 @@ def smart_write_open(file_name):
     fhd.close()
 
 
-def get_file_meth(bed_file, output_file, methylation, coverage, options):
-    basename = bed_file.rsplit('.',1)[0]
-    with open(bed_file) as intput_fhd, \
-         smart_write_open(output_file) as output_fhd:
-        output_csv = csv.writer(output_fhd)
-        output_csv.writerow(['chrom','start','end','name','value','strand'])
+def load_regions(bed_file):
+    '''Regions of bed_file as (chrom, start, end, name, strand)'''
+    regions = []
+    with open(bed_file) as intput_fhd:
         line_n = 0
         for line in intput_fhd:
             if not line:
@@ -151,10 +171,62 @@ def get_file_meth(bed_file, output_file, methylation, coverage, options):
             start, end = int(start), int(end)
             name = line[3] if len(line) > 3 else f'R{line_n:d}'
             strand = line[5] if len(line) > 5 else '.'
-            value = get_region_meth((chrom, start, end), methylation, coverage, options)
+            regions.append((chrom, start, end, name, strand))
+    return regions
+
+
+def get_file_meth(bed_file, output_file, methylation, coverage, options):
+    regions = load_regions(bed_file)
+    values = get_regions_meth(region_windows(regions, options), len(regions), methylation, coverage)
+    with smart_write_open(output_file) as output_fhd:
+        output_csv = csv.writer(output_fhd)
+        output_csv.writerow(['chrom','start','end','name','value','strand'])
+        for (chrom, start, end, name, strand), value in zip(regions, values):
             output_line = [chrom, start, end, name, f'{value:.3f}', strand]
             output_csv.writerow(output_line)
- 
+
+
+# regions & windows of bed files shared with forked workers
+_sample_job = None
+
+
+def get_sample_meth(meth_file):
+    '''Load one sample & get its levels over regions of each bed file'''
+    bed_windows, coverage = _sample_job
+    methylation = load_meth(meth_file)
+    return [get_regions_meth(windows, len(regions), methylation, coverage) for regions, windows in bed_windows]
+
+
+def get_matrix_meth(options):
+    '''
+    Write regions x samples matrix of each bed file. Bed files are parsed and
+    windows are computed once for all samples, samples are loaded and
+    processed by options.processes processes.
+    '''
+    global _sample_job
+    bed_windows = []
+    for bed_file in options.bed:
+        regions = load_regions(bed_file)
+        bed_windows.append((regions, region_windows(regions, options)))
+    _sample_job = (bed_windows, options.coverage)
+    if options.processes > 1:
+        with ProcessPoolExecutor(max_workers=options.processes,
+                                 mp_context=get_context('fork')) as executor:
+            sample_values = list(executor.map(get_sample_meth, options.meth))
+    else:
+        sample_values = [get_sample_meth(meth_file) for meth_file in options.meth]
+    _sample_job = None
+
+    sample_names = [os.path.basename(meth_file).split('.')[0] for meth_file in options.meth]
+    for i, ((regions, _), output_file) in enumerate(zip(bed_windows, options.output)):
+        matrix = np.column_stack([values[i] for values in sample_values])
+        with smart_write_open(output_file) as output_fhd:
+            output_csv = csv.writer(output_fhd)
+            output_csv.writerow(['chrom','start','end','name','strand'] + sample_names)
+            for (chrom, start, end, name, strand), values in zip(regions, matrix):
+                output_line = [chrom, start, end, name, strand] + [f'{value:.3f}' for value in values]
+                output_csv.writerow(output_line)
+
 
 # ------------------------------------
 # Main function
@@ -164,8 +236,13 @@ def main():
     # read the options
     options = opt_validate(prepare_optparser())
     
+    # regions x samples matrix for multiple samples
+    if len(options.meth) > 1:
+        get_matrix_meth(options)
+        return
+    
     # load methylation information
-    methylation = load_meth(options.meth)
+    methylation = load_meth(options.meth[0])
     
     # get methylation information for each file
     for bed_file, output_file in zip(options.bed, options.output):
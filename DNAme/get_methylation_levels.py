@@ -10,6 +10,7 @@ import numpy as np
 from optparse import OptionParser
 from collections import defaultdict
 from contextlib import contextmanager
+from methylation_store import load_meth
 
 
 # ------------------------------------
@@ -84,35 +85,16 @@ def opt_validate(optparser):
     return options
 
 
-def load_meth(meth_file):
-    methylation = defaultdict(dict)
-    # {chrom: pos: {(ratio,totalC,methC)}}
-    with open(meth_file) as fhd:
-        for line in fhd:
-            if line[0] == '#' or not line:
-                continue
-            line = line.strip().split()
-            if len(line) < 15: # handle extra line in the bottom of XX.bam.G.bed
-                continue
-            methylation[line[0]][int(line[1])] = (float(line[3]), int(line[4]), int(line[5]))
-    return methylation
-
-
-def get_region_meth(region, points, methylation, coverage):
-    
-    (chrom, start, end) = region
-    meth_val = []
-    boundaries = np.linspace(start,end,points+1)
-    for i in range(points):
-        start, end = int(boundaries[i]), int(boundaries[i+1])
-        m, total, n = 0, 0, 0
-        for pos in range(start-1,end):
-            if pos in methylation[chrom]:
-                n += 1
-                m += methylation[chrom][pos][2]
-                total += methylation[chrom][pos][1]
-        meth_val.append(np.nan if n == 0 or total / n < coverage else m / total)
-    return meth_val
+def get_chrom_meth(chrom, starts, ends, points, methylation, coverage):
+    '''
+    (regions x points) methylation level matrix of regions of chrom, bins of
+    all regions are computed at once.
+    '''
+    boundaries = np.linspace(starts, ends, points+1, axis=1).astype(np.int64)
+    bin_starts, bin_ends = boundaries[:, :-1], boundaries[:, 1:]
+    m, total, n = (methylation.window_sum(chrom, bin_starts-1, bin_ends, name) for name in ['meth', 'total', 'count'])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where((n == 0) | (total == 0) | (total / n < coverage), np.nan, m / total)
 
 
 @contextmanager
@@ -123,10 +105,8 @@ def smart_write_open(file_name):
 
 
 def get_file_meth(bed_file, output_file, points, methylation, coverage, strand):
-    basename = bed_file.rsplit('.',1)[0]
-    with open(bed_file) as intput_fhd, \
-         smart_write_open(output_file) as output_fhd:
-        output_csv = csv.writer(output_fhd)
+    regions = []
+    with open(bed_file) as intput_fhd:
         line_n = 0
         for line in intput_fhd:
             if not line:
@@ -146,9 +126,22 @@ def get_file_meth(bed_file, output_file, points, methylation, coverage, strand):
                     sys.stdout.write(f'Invalid strand for line: {line}\n')
                     sys.exit(1)
             start, end = int(start), int(end)
-            name = line[3] if len(line) > 3 else f'R{line_n:d}'
-            meth_val = get_region_meth((chrom, start, end), points, methylation, coverage)
-            output_csv.writerow(meth_val[::-1] if r_strand == '-' else meth_val)
+            regions.append((chrom, start, end, r_strand))
+
+    # regions of each chrom at once
+    matrix = np.zeros((len(regions), points))
+    chrom_index = defaultdict(list)
+    for i, region in enumerate(regions):
+        chrom_index[region[0]].append(i)
+    for chrom, index in chrom_index.items():
+        starts = np.array([regions[i][1] for i in index], dtype=np.int64)
+        ends = np.array([regions[i][2] for i in index], dtype=np.int64)
+        matrix[index] = get_chrom_meth(chrom, starts, ends, points, methylation, coverage)
+
+    with smart_write_open(output_file) as output_fhd:
+        output_csv = csv.writer(output_fhd)
+        for region, meth_val in zip(regions, matrix.tolist()):
+            output_csv.writerow(meth_val[::-1] if region[3] == '-' else meth_val)
 
 
 # ------------------------------------
@@ -9,6 +9,7 @@ from optparse import OptionParser
 import numpy as np
 from collections import defaultdict
 from contextlib import contextmanager
+from methylation_store import load_meth, sliding_windows, reduce_windows
 
 
 # ------------------------------------
@@ -89,43 +90,27 @@ def opt_validate(optparser):
     return options
 
 
-def load_meth(meth_file):
-    methylation = defaultdict(dict)
-    # {chrom: pos: {(ratio,totalC,methC)}}
-    with open(meth_file) as fhd:
-        for line in fhd:
-            if line[0] == '#' or not line:
-                continue
-            line = line.strip().split()
-            if len(line) < 15: # handle extra line in the bottom of XX.bam.G.bed
-                continue
-            methylation[line[0]][int(line[1])] = (float(line[3]), int(line[4]), int(line[5]))
-    return methylation
-
-
 def _get_region_unmethylCpG(region, methylation, coverage):
+    '''
+    Number of unmethylated CpGs, start & end can be arrays of windows.
+    '''
     (chrom, start, end) = region
-    um = 0
-    for pos in range(start-1,end):
-        if pos in methylation[chrom]:
-            if methylation[chrom][pos][1] >=5 and methylation[chrom][pos][0] <= 0.2:
-                um += 1
-    return um
+    unmethylated = lambda ratio, total, meth: (total >= 5) & (ratio <= 0.2)
+    return methylation.window_sum(chrom, start-1, end, 'unmethylated', unmethylated)
 
 
-def get_region_unmethylCpG(region, methylation, coverage, options):
+def get_chrom_unmethylCpG(chrom, starts, ends, methylation, coverage, options):
     '''
+    UnmethylCpG number of regions of chrom, all windows of all regions are
+    computed at once. With -w & -s, the number of a region is the maximum of
+    its sliding windows, nan if it has no window.
     '''
-    (chrom, start, end) = region
     if options.window and options.step:
-        region_um = []
-        for i in range((end - start - options.window) // options.step):
-            _start = start + i * options.step
-            _end = _start + options.window
-            region_um.append(_get_region_unmethylCpG((chrom, _start, _end), methylation, coverage))
-        return np.nanmax(region_um) if region_um else np.nan
+        window_starts, counts = sliding_windows(starts, ends, options.window, options.step)
+        values = _get_region_unmethylCpG((chrom, window_starts, window_starts + options.window), methylation, coverage)
+        return reduce_windows(np.fmax, values, counts)
     else:
-        return _get_region_unmethylCpG(region, methylation, coverage)
+        return _get_region_unmethylCpG((chrom, starts, ends), methylation, coverage)
 
 
 @contextmanager
@@ -136,11 +121,8 @@ def smart_write_open(file_name):
 
 
 def get_file_meth(bed_file, output_file, methylation, coverage, options):
-    basename = bed_file.rsplit('.',1)[0]
-    with open(bed_file) as intput_fhd, \
-         smart_write_open(output_file) as output_fhd:
-        output_csv = csv.writer(output_fhd)
-        output_csv.writerow(['chrom','start','end','name','value','strand'])
+    regions = []
+    with open(bed_file) as intput_fhd:
         line_n = 0
         for line in intput_fhd:
             if not line:
@@ -151,10 +133,26 @@ def get_file_meth(bed_file, output_file, methylation, coverage, options):
             start, end = int(start), int(end)
             name = line[3] if len(line) > 3 else f'R{line_n:d}'
             strand = line[5] if len(line) > 5 else '.'
-            value = get_region_unmethylCpG((chrom, start, end), methylation, coverage, options)
-            output_line = [chrom, start, end, name, f'{value:d}', strand]
+            regions.append((chrom, start, end, name, strand))
+
+    # regions of each chrom at once
+    values = np.zeros(len(regions))
+    chrom_index = defaultdict(list)
+    for i, region in enumerate(regions):
+        chrom_index[region[0]].append(i)
+    for chrom, index in chrom_index.items():
+        starts = np.array([regions[i][1] for i in index], dtype=np.int64)
+        ends = np.array([regions[i][2] for i in index], dtype=np.int64)
+        values[index] = get_chrom_unmethylCpG(chrom, starts, ends, methylation, coverage, options)
+
+    with smart_write_open(output_file) as output_fhd:
+        output_csv = csv.writer(output_fhd)
+        output_csv.writerow(['chrom','start','end','name','value','strand'])
+        for (chrom, start, end, name, strand), value in zip(regions, values):
+            value = 'nan' if np.isnan(value) else f'{int(value):d}'
+            output_line = [chrom, start, end, name, value, strand]
             output_csv.writerow(output_line)
- 
+
 
 # ------------------------------------
 # Main function
@@ -9,6 +9,7 @@ from optparse import OptionParser
 import numpy as np
 from collections import defaultdict
 from contextlib import contextmanager
+from methylation_store import load_meth
 
 
 # ------------------------------------
@@ -81,28 +82,13 @@ def opt_validate(optparser):
     return options
 
 
-def load_meth(meth_file):
-    methylation = defaultdict(dict)
-    # {chrom: pos: {(ratio,totalC,methC)}}
-    with open(meth_file) as fhd:
-        for line in fhd:
-            if line[0] == '#' or not line:
-                continue
-            line = line.strip().split()
-            if len(line) < 15: # handle extra line in the bottom of XX.bam.G.bed
-                continue
-            methylation[line[0]][int(line[1])] = (float(line[3]), int(line[4]), int(line[5]))
-    return methylation
-
-
 def _get_region_unmethylCpG(region, methylation, coverage):
+    '''
+    Number of unmethylated CpGs, start & end can be arrays of windows.
+    '''
     (chrom, start, end) = region
-    um = 0
-    for pos in range(start-1,end):
-        if pos in methylation[chrom]:
-            if methylation[chrom][pos][1] >=5 and methylation[chrom][pos][0] <= 0.2:
-                um += 1
-    return um
+    unmethylated = lambda ratio, total, meth: (total >= 5) & (ratio <= 0.2)
+    return methylation.window_sum(chrom, start-1, end, 'unmethylated', unmethylated)
 
 
 @contextmanager
@@ -123,18 +109,17 @@ def get_file_meth(bed_file, output_file, methylation, coverage, options):
             n += 1
     matrix = np.zeros(shape=(n,options.points))
 
-    # get unmthylCpG number
-    i = 0
+    # get unmthylCpG number, points of all regions of each chrom at once
+    chrom_index = defaultdict(list)
+    region_starts = np.zeros(n, dtype=np.int64)
     with open(bed_file) as intput_fhd:
-        for line in intput_fhd:
-            if not line:
-                continue
+        for i, line in enumerate(intput_fhd):
             line = line.strip().split()
-            chrom, start, end = line[0], int(line[1]), int(line[2])
-            start, end = int(start), int(end)
-            for j in range(options.points):
-                matrix[i][j] = _get_region_unmethylCpG((chrom, start+j*step, start+j*step+step), methylation, coverage)
-            i += 1
+            chrom_index[line[0]].append(i)
+            region_starts[i] = int(line[1])
+    for chrom, index in chrom_index.items():
+        bin_starts = region_starts[index][:, None] + np.arange(options.points) * step
+        matrix[index] = _get_region_unmethylCpG((chrom, bin_starts, bin_starts+step), methylation, coverage)
     # output
     np.savetxt(output_file,matrix,delimiter=',',fmt='%d')
  
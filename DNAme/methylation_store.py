@@ -0,0 +1,260 @@
+#! /usr/bin/env python3
+
+# Shared methylation store of DNAme scripts.
+
+import os
+import shutil
+from array import array
+from collections import defaultdict
+import numpy as np
+
+# ------------------------------------
+# Constants
+# ------------------------------------
+# binary index of a methylation info file: one .npy per column with CpGs of
+# all chroms, chroms.npy & offsets.npy locate CpGs of each chrom
+INDEX_SUFFIX = '.index'
+INDEX_COLUMNS = [('positions', np.int32), ('ratio', np.float64), ('total', np.int32), ('meth', np.int32)]
+# only columns 0-5 are stored, shorter lines (the mcall trailer) are skipped
+INDEX_MIN_COLUMNS = 6
+
+
+# ------------------------------------
+# Classes
+# ------------------------------------
+class MethylationStore():
+    '''
+    Methylation of CpGs in columns of each chromosome, sorted by position:
+    positions (int32), ratio (float64), totalC (int32) and methC (int32).
+    About 20 bytes per CpG, instead of a dict item & tuple per CpG.
+
+    Sums over windows are differences of cumulative sums at two
+    searchsorted indexes, cumulative sums are computed on first use. If
+    columns are memory-mapped (see load_index), cumulative sums are computed
+    over CpGs in the queried windows only, so pages of other CpGs are never
+    read.
+    '''
+
+    def __init__(self, columns=None, mmap=False):
+        # {chrom: (positions, ratio, total, meth)}
+        self.columns = columns if columns is not None else {}
+        self.mmap = mmap
+        # {(chrom, name): cumulative sum with leading 0}
+        self.prefix_sums = {}
+
+    def __contains__(self, chrom):
+        return chrom in self.columns
+
+    def __len__(self):
+        return sum(len(columns[0]) for columns in self.columns.values())
+
+    def chroms(self):
+        return list(self.columns)
+
+    def chrom_columns(self, chrom):
+        '''(positions, ratio, total, meth) of chrom, empty if no CpG'''
+        if chrom not in self.columns:
+            return (np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.float64),
+                    np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32))
+        return self.columns[chrom]
+
+    def region(self, chrom, start, end):
+        '''(positions, ratio, total, meth) of CpGs with start <= pos < end'''
+        columns = self.chrom_columns(chrom)
+        lo, hi = np.searchsorted(columns[0], [start, end])
+        return tuple(column[lo:hi] for column in columns)
+
+    def column(self, chrom, name, values=None, index=None):
+        '''
+        Value of each CpG of chrom, or CpGs at index if given. name is total
+        or meth, or any name with values, a function of (ratio, total, meth)
+        columns returning the value of each CpG.
+        '''
+        _, ratio, total, meth = self.chrom_columns(chrom)
+        if index is not None:
+            ratio, total, meth = ratio[index], total[index], meth[index]
+        if values is not None:
+            return values(ratio, total, meth)
+        elif name == 'total':
+            return total
+        elif name == 'meth':
+            return meth
+        else:
+            raise ValueError(f'Unknown column: {name}.')
+
+    def prefix_sum(self, chrom, name, values=None):
+        '''Cumulative sum of a column of chrom with a leading 0, cached by name'''
+        key = (chrom, name)
+        if key not in self.prefix_sums:
+            self.prefix_sums[key] = _cumsum(self.column(chrom, name, values))
+        return self.prefix_sums[key]
+
+    def window_sum(self, chrom, starts, ends, name, values=None):
+        '''
+        Sum of a column (see column) over CpGs with starts <= pos < ends,
+        starts & ends can be numbers or arrays of windows. name count is the
+        number of CpGs, from the searchsorted indexes only.
+        '''
+        positions = self.chrom_columns(chrom)[0]
+        lo, hi = np.searchsorted(positions, starts), np.searchsorted(positions, ends)
+        if name == 'count' and values is None:
+            return hi - lo
+        if not self.mmap:
+            cumsum = self.prefix_sum(chrom, name, values)
+            return cumsum[hi] - cumsum[lo]
+        index = _window_cpgs(len(positions), lo, hi)
+        cumsum = _cumsum(self.column(chrom, name, values, index))
+        return cumsum[np.searchsorted(index, hi)] - cumsum[np.searchsorted(index, lo)]
+
+    @property
+    def nbytes(self):
+        return sum(column.nbytes for columns in self.columns.values()
+                   for column in columns)
+
+
+# ------------------------------------
+# Sub Functions
+# ------------------------------------
+def _cumsum(column):
+    '''Cumulative sum with a leading 0, in float64 or int64'''
+    dtype = np.float64 if np.issubdtype(column.dtype, np.floating) else np.int64
+    cumsum = np.zeros(len(column) + 1, dtype=dtype)
+    np.cumsum(column, dtype=dtype, out=cumsum[1:])
+    return cumsum
+
+
+def _window_cpgs(n_cpgs, lo, hi):
+    '''Index of CpGs in any window [lo, hi), windows are continuous ranges of them'''
+    depth = np.bincount(np.ravel(lo), minlength=n_cpgs+1) - np.bincount(np.ravel(hi), minlength=n_cpgs+1)
+    return np.flatnonzero(np.cumsum(depth[:-1]) > 0)
+
+
+def index_dir_of(meth_file):
+    return f'{meth_file}{INDEX_SUFFIX}'
+
+
+def index_is_fresh(meth_file, index_dir=None):
+    '''If the binary index exists and is newer than meth_file'''
+    index_dir = index_dir or index_dir_of(meth_file)
+    offsets_file = os.path.join(index_dir, 'offsets.npy')
+    if not os.path.isfile(offsets_file):
+        return False
+    return os.path.getmtime(offsets_file) >= os.path.getmtime(meth_file)
+
+
+def load_meth(meth_file, mmap=True, min_columns=15):
+    '''
+    Load methylation info file to MethylationStore, from its binary index
+    (see build_index) if it is fresh. The index is memory-mapped if mmap is
+    set, see load_index. min_columns is passed to parse_meth, an index is
+    built with INDEX_MIN_COLUMNS.
+    '''
+    if index_is_fresh(meth_file):
+        return load_index(index_dir_of(meth_file), mmap)
+    return parse_meth(meth_file, min_columns)
+
+
+def parse_meth(meth_file, min_columns=15):
+    '''
+    Parse mcall methylation info file (XX.bam.G.bed) to MethylationStore,
+    lines with less than min_columns columns are skipped.
+    '''
+    # per chrom typed arrays while loading, no Python object per CpG
+    loading = defaultdict(lambda: (array('i'), array('d'), array('i'), array('i')))
+    with open(meth_file) as fhd:
+        for line in fhd:
+            if line[0] == '#' or not line:
+                continue
+            line = line.strip().split()
+            if len(line) < min_columns: # handle extra line in the bottom of XX.bam.G.bed
+                continue
+            positions, ratio, total, meth = loading[line[0]]
+            positions.append(int(line[1]))
+            ratio.append(float(line[3]))
+            total.append(int(line[4]))
+            meth.append(int(line[5]))
+
+    columns = {}
+    for chrom, arrays in loading.items():
+        positions, ratio, total, meth = (np.frombuffer(column, dtype=dtype) for column, dtype in zip(arrays, [np.int32, np.float64, np.int32, np.int32]))
+        order = np.argsort(positions, kind='stable')
+        positions = positions[order]
+        # the last line of a position is kept, as a dict does
+        keep = np.append(positions[1:] != positions[:-1], True)
+        order = order[keep]
+        columns[chrom] = (positions[keep], ratio[order], total[order], meth[order])
+    return MethylationStore(columns)
+
+
+def save_index(store, index_dir):
+    '''Save store as a binary index, other runs never see a partial index'''
+    chroms = store.chroms()
+    lengths = [len(store.chrom_columns(chrom)[0]) for chrom in chroms]
+    temp_dir = f'{index_dir}.{os.getpid()}.tmp'
+    os.makedirs(temp_dir, exist_ok=True)
+    try:
+        for i, (name, dtype) in enumerate(INDEX_COLUMNS):
+            column = [store.chrom_columns(chrom)[i] for chrom in chroms]
+            np.save(os.path.join(temp_dir, f'{name}.npy'), np.concatenate(column) if column else np.zeros(0, dtype=dtype))
+        np.save(os.path.join(temp_dir, 'chroms.npy'), np.array(chroms, dtype=str))
+        # CpGs of chroms[i] are [offsets[i], offsets[i+1]) of each column
+        np.save(os.path.join(temp_dir, 'offsets.npy'), np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64))
+        if os.path.isdir(index_dir):
+            shutil.rmtree(index_dir)
+        os.replace(temp_dir, index_dir)
+    finally:
+        if os.path.isdir(temp_dir):
+            shutil.rmtree(temp_dir)
+
+
+def load_index(index_dir, mmap=False):
+    '''
+    Load binary index to MethylationStore, columns of chroms are views. If
+    mmap is set, columns are read-only np.memmap: nothing is read until
+    queried, only pages of queried chroms & windows are read, and pages are
+    shared by all processes reading the same index through the page cache.
+    '''
+    chroms = np.load(os.path.join(index_dir, 'chroms.npy')).tolist()
+    offsets = np.load(os.path.join(index_dir, 'offsets.npy'))
+    columns = [np.load(os.path.join(index_dir, f'{name}.npy'), mmap_mode='r' if mmap else None) for name, _ in INDEX_COLUMNS]
+    return MethylationStore({
+        chrom: tuple(column[offsets[i]:offsets[i+1]] for column in columns)
+        for i, chrom in enumerate(chroms)
+    }, mmap)
+
+
+def build_index(meth_file, index_dir=None):
+    '''
+    Parse meth_file once & save its binary index, return the index dir. Raise
+    ValueError if meth_file has no CpG, no empty index is written.
+    '''
+    index_dir = index_dir or index_dir_of(meth_file)
+    store = parse_meth(meth_file, INDEX_MIN_COLUMNS)
+    if len(store) == 0:
+        raise ValueError(f'No CpG found in {meth_file}, index is not built.')
+    save_index(store, index_dir)
+    return index_dir
+
+
+def sliding_windows(starts, ends, window, step):
+    '''
+    Starts of sliding windows of all regions at once, (end - start - window)
+    // step windows for each region. Return (window_starts, counts), windows
+    of region i are window_starts[offsets[i]:offsets[i] + counts[i]] with
+    offsets = np.cumsum(counts) - counts.
+    '''
+    counts = np.maximum((ends - starts - window) // step, 0)
+    offsets = np.cumsum(counts) - counts
+    region_index = np.repeat(np.arange(len(starts)), counts)
+    window_index = np.arange(counts.sum()) - offsets[region_index]
+    return starts[region_index] + window_index * step, counts
+
+
+def reduce_windows(ufunc, values, counts):
+    '''Reduce values of windows to regions by ufunc, nan for no window'''
+    result = np.full(len(counts), np.nan)
+    has_window = counts > 0
+    if has_window.any():
+        offsets = np.cumsum(counts) - counts
+        result[has_window] = ufunc.reduceat(values, offsets[has_window])
+    return result
@@ -0,0 +1,404 @@
+#!/usr/bin/env python3
+
+# ------------------------------------
+# Import Modules
+# ------------------------------------
+import struct
+import time
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+# ------------------------------------
+# Constants
+# ------------------------------------
+BIGWIG_MAGIC = 0x888FFC26
+CHROM_TREE_MAGIC = 0x78CA8C91
+R_TREE_MAGIC = 0x2468ACE0
+BLOCK_CACHE_SIZE = 256  # decoded data blocks kept in memory
+
+# bedGraph, varStep & fixedStep section types
+BEDGRAPH, VARSTEP, FIXEDSTEP = 1, 2, 3
+
+
+# ------------------------------------
+# Classes
+# ------------------------------------
+class BigWigFile():
+    """Read bigWig file in process, without bigWigSummary
+
+The file is opened once, chromosome list & index nodes are kept in memory and
+data blocks are read & decompressed on query. The last block_cache_size
+decoded blocks are kept in a LRU cache, so nearby queries decode each block
+once. Bytes & seconds of file reads, decompressed bytes and cache hits &
+misses are counted for progress report.
+"""
+
+    def __init__(self,
+                 file_name: str,
+                 block_cache_size: int = BLOCK_CACHE_SIZE):
+        self.file_name = file_name
+        self.fhd = open(file_name, 'rb')
+        self.index_nodes = {}
+        # offsets of R tree indexes with a checked magic, full & zoom levels
+        self.checked_indexes = set()
+        self.block_cache = OrderedDict()
+        self.block_cache_size = block_cache_size
+        self.cache_hits, self.cache_misses = 0, 0
+        self.bytes_read, self.read_seconds, self.bytes_decompressed = 0, 0.0, 0
+        self._read_header()
+        self._read_chroms()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self) -> None:
+        self.fhd.close()
+
+    def _read(self, offset: int, size: int) -> bytes:
+        start = time.perf_counter()
+        self.fhd.seek(offset)
+        data = self.fhd.read(size)
+        self.read_seconds += time.perf_counter() - start
+        self.bytes_read += len(data)
+        return data
+
+    def _read_header(self) -> None:
+        data = self._read(0, 64)
+        if struct.unpack('<I', data[:4])[0] == BIGWIG_MAGIC:
+            self.endian = '<'
+        elif struct.unpack('>I', data[:4])[0] == BIGWIG_MAGIC:
+            self.endian = '>'
+        else:
+            raise ValueError(f'{self.file_name} is not a bigWig file.')
+        (_, self.version, zoom_levels, self.chrom_tree_offset,
+         self.full_data_offset, self.full_index_offset, _, _, _, _,
+         self.uncompress_buf_size,
+         _) = struct.unpack(f'{self.endian}IHHQQQHHQQIQ', data)
+
+        # zoom headers: reductionLevel, reserved, dataOffset, indexOffset
+        data = self._read(64, zoom_levels * 24)
+        self.zoom_levels = [
+            struct.unpack_from(f'{self.endian}IIQQ', data, i * 24)
+            for i in range(zoom_levels)
+        ]
+
+        # numpy dtypes of sections
+        e = self.endian
+        self.section_dtype = np.dtype([('chrom_id', f'{e}u4'),
+                                       ('start', f'{e}u4'), ('end', f'{e}u4'),
+                                       ('step', f'{e}u4'), ('span', f'{e}u4'),
+                                       ('type', 'u1'), ('reserved', 'u1'),
+                                       ('count', f'{e}u2')])
+        self.item_dtypes = {
+            BEDGRAPH:
+            np.dtype([('start', f'{e}u4'), ('end', f'{e}u4'),
+                      ('value', f'{e}f4')]),
+            VARSTEP:
+            np.dtype([('start', f'{e}u4'), ('value', f'{e}f4')]),
+            FIXEDSTEP:
+            np.dtype([('value', f'{e}f4')])
+        }
+        self.zoom_dtype = np.dtype([('chrom_id', f'{e}u4'),
+                                    ('start', f'{e}u4'), ('end', f'{e}u4'),
+                                    ('valid', f'{e}u4'), ('min', f'{e}f4'),
+                                    ('max', f'{e}f4'), ('sum', f'{e}f4'),
+                                    ('sum_squares', f'{e}f4')])
+
+    def _read_chroms(self) -> None:
+        """Load chromosome B+ tree as {chrom: (chrom_id, chrom_size)}"""
+
+        data = self._read(self.chrom_tree_offset, 32)
+        magic, _, key_size, _, _, _ = struct.unpack(f'{self.endian}IIIIQQ',
+                                                    data)
+        if magic != CHROM_TREE_MAGIC:
+            raise ValueError(f'Invalid chromosome tree in {self.file_name}.')
+        self.chroms = {}
+        self._read_chrom_node(self.chrom_tree_offset + 32, key_size)
+
+    def _read_chrom_node(self, offset: int, key_size: int) -> None:
+        is_leaf, _, count = struct.unpack(f'{self.endian}BBH',
+                                          self._read(offset, 4))
+        data = self._read(offset + 4, count * (key_size + 8))
+        for i in range(count):
+            item_offset = i * (key_size + 8)
+            key = data[item_offset:item_offset + key_size].rstrip(b'\x00')
+            if is_leaf:
+                chrom_id, chrom_size = struct.unpack_from(
+                    f'{self.endian}II', data, item_offset + key_size)
+                self.chroms[key.decode()] = (chrom_id, chrom_size)
+            else:
+                child_offset = struct.unpack_from(f'{self.endian}Q', data,
+                                                  item_offset + key_size)[0]
+                self._read_chrom_node(child_offset, key_size)
+
+    def _index_node(self, offset: int) -> tuple:
+        """Read one R tree node & cache it, return (is_leaf, items)
+
+items are (start_chrom, start_base, end_chrom, end_base, data_offset,
+data_size) for leaf nodes, and data_size is 0 for non-leaf nodes.
+"""
+        if offset not in self.index_nodes:
+            is_leaf, _, count = struct.unpack(f'{self.endian}BBH',
+                                              self._read(offset, 4))
+            if is_leaf:
+                data = self._read(offset + 4, count * 32)
+                items = [
+                    struct.unpack_from(f'{self.endian}IIIIQQ', data, i * 32)
+                    for i in range(count)
+                ]
+            else:
+                data = self._read(offset + 4, count * 24)
+                items = [
+                    struct.unpack_from(f'{self.endian}IIIIQ', data, i * 24) +
+                    (0, ) for i in range(count)
+                ]
+            self.index_nodes[offset] = (is_leaf, items)
+        return self.index_nodes[offset]
+
+    def _overlapped_blocks(self, index_offset: int, chrom_id: int, start: int,
+                           end: int) -> list:
+        """(data_offset, data_size) of blocks overlapped with region"""
+
+        if index_offset not in self.checked_indexes:
+            magic = struct.unpack(f'{self.endian}I',
+                                  self._read(index_offset, 4))[0]
+            if magic != R_TREE_MAGIC:
+                raise ValueError(f'Invalid R tree index in {self.file_name}.')
+            self.checked_indexes.add(index_offset)
+        blocks = []
+        nodes = [index_offset + 48]
+        while nodes:
+            is_leaf, items = self._index_node(nodes.pop())
+            children = []
+            for (start_chrom, start_base, end_chrom, end_base, data_offset,
+                 data_size) in items:
+                # item overlaps if (chrom_id, start) < item end and
+                # item start < (chrom_id, end)
+                if (start_chrom, start_base) >= (chrom_id, end):
+                    continue
+                if (end_chrom, end_base) <= (chrom_id, start):
+                    continue
+                if is_leaf:
+                    blocks.append((data_offset, data_size))
+                else:
+                    children.append(data_offset)
+            nodes.extend(reversed(children))
+        return blocks
+
+    def _decode_block(self, offset: int, size: int) -> bytes:
+        data = self._read(offset, size)
+        if self.uncompress_buf_size > 0:
+            data = zlib.decompress(data)
+        self.bytes_decompressed += len(data)
+        return data
+
+    def _cached_block(self, offset: int, size: int, decoder=None):
+        """Decoded block at offset, from LRU cache if possible
+
+decoder turns uncompressed data into the cached object, _block_intervals by
+default. Offsets are unique in the file, so base level & zoom blocks share
+the cache.
+"""
+
+        if offset in self.block_cache:
+            self.cache_hits += 1
+            self.block_cache.move_to_end(offset)
+            return self.block_cache[offset]
+        self.cache_misses += 1
+        decoder = decoder or self._block_intervals
+        block = decoder(self._decode_block(offset, size))
+        if self.block_cache_size > 0:
+            self.block_cache[offset] = block
+            if len(self.block_cache) > self.block_cache_size:
+                self.block_cache.popitem(last=False)
+        return block
+
+    def _block_intervals(self, data: bytes) -> tuple:
+        """Decode one data block to (chrom_id, starts, ends, values)"""
+
+        header = np.frombuffer(data, dtype=self.section_dtype, count=1)[0]
+        items = np.frombuffer(data,
+                              dtype=self.item_dtypes[int(header['type'])],
+                              count=int(header['count']),
+                              offset=self.section_dtype.itemsize)
+        values = items['value'].astype(np.float64)
+        if header['type'] == BEDGRAPH:
+            starts = items['start'].astype(np.int64)
+            ends = items['end'].astype(np.int64)
+        elif header['type'] == VARSTEP:
+            starts = items['start'].astype(np.int64)
+            ends = starts + int(header['span'])
+        else:
+            starts = int(header['start']) + int(header['step']) * np.arange(
+                len(items), dtype=np.int64)
+            ends = starts + int(header['span'])
+        return int(header['chrom_id']), starts, ends, values
+
+    def _zoom_records(self, data: bytes) -> np.ndarray:
+        return np.frombuffer(data,
+                             dtype=self.zoom_dtype,
+                             count=len(data) // self.zoom_dtype.itemsize)
+
+    def best_zoom(self, bases_per_bin: int):
+        """Zoom level to summarize bins of bases_per_bin, None for base level
+
+Same as bbiBestZoom of bigWigSummary: the most reduced level not larger than
+half of the bin size.
+"""
+        desired = bases_per_bin // 2
+        if desired <= 1:
+            return None
+        levels = [level for level in self.zoom_levels if level[0] <= desired]
+        return max(levels, key=lambda level: level[0]) if levels else None
+
+    def zoom_intervals(self, chrom: str, start: int, end: int,
+                       zoom: tuple) -> tuple:
+        """Summary (starts, ends, valid, sums) arrays of zoom level overlapped
+with region, valid & sums are covered bases & sum of values of each record.
+"""
+        empty = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64),
+                 np.zeros(0, dtype=np.float64), np.zeros(0, dtype=np.float64))
+        if chrom not in self.chroms or start >= end:
+            return empty
+        chrom_id = self.chroms[chrom][0]
+        parts = []
+        for offset, size in self._overlapped_blocks(zoom[3], chrom_id, start,
+                                                    end):
+            records = self._cached_block(offset, size, self._zoom_records)
+            records = records[(records['chrom_id'] == chrom_id)
+                              & (records['end'] > start)
+                              & (records['start'] < end)]
+            parts.append(records)
+        if not parts:
+            return empty
+        records = np.concatenate(parts)
+        records = records[np.argsort(records['start'], kind='stable')]
+        return (records['start'].astype(np.int64),
+                records['end'].astype(np.int64),
+                records['valid'].astype(np.float64),
+                records['sum'].astype(np.float64))
+
+    def intervals(self, chrom: str, start: int, end: int) -> tuple:
+        """Base level (starts, ends, values) arrays overlapped with region"""
+
+        empty = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64),
+                 np.zeros(0, dtype=np.float64))
+        if chrom not in self.chroms or start >= end:
+            return empty
+        chrom_id = self.chroms[chrom][0]
+        parts = []
+        for offset, size in self._overlapped_blocks(self.full_index_offset,
+                                                    chrom_id, start, end):
+            block_chrom_id, starts, ends, values = self._cached_block(
+                offset, size)
+            if block_chrom_id != chrom_id:
+                continue
+            keep = (ends > start) & (starts < end)
+            parts.append((starts[keep], ends[keep], values[keep]))
+        if not parts:
+            return empty
+        starts, ends, values = (np.concatenate(column)
+                                for column in zip(*parts))
+        order = np.argsort(starts, kind='stable')
+        return starts[order], ends[order], values[order]
+
+    def summarize(self,
+                  chrom: str,
+                  start: int,
+                  end: int,
+                  n_bins: int,
+                  exact: bool = True) -> tuple:
+        """Covered bases & sum of values of each bin
+
+Bins are split as bigWigSummary: bin i is [start + (end - start) * i //
+n_bins, start + (end - start) * (i + 1) // n_bins). If exact is False, bins
+are summarized from the zoom level chosen by best_zoom when there is one,
+and records partially overlapped with a bin are prorated by overlapped bases.
+
+Returns
+----------
+valid : float array, number of bases with data
+sums : float array, sum of values over bases with data
+"""
+        boundaries = start + (end - start) * np.arange(n_bins + 1,
+                                                       dtype=np.int64) // n_bins
+        zoom = None if exact else self.best_zoom((end - start) // n_bins)
+        if zoom is None:
+            starts, ends, values = self.intervals(chrom, start, end)
+            return bin_intervals(starts, ends, values, boundaries)
+        starts, ends, valid, sums = self.zoom_intervals(chrom, start, end,
+                                                        zoom)
+        lengths = ends - starts
+        return bin_intervals(starts, ends, sums / lengths, boundaries,
+                             valid / lengths)
+
+    def stats(self,
+              chrom: str,
+              start: int,
+              end: int,
+              n_bins: int,
+              type: str = 'mean',
+              exact: bool = True):
+        """Mean value or coverage of each bin, nan for bins without data
+
+type : mean or coverage
+        coverage is covered bases divided by the average bin size, same as
+        bigWigSummary -type=coverage.
+"""
+        valid, sums = self.summarize(chrom, start, end, n_bins, exact)
+        return summary_values(valid, sums, (end - start) / n_bins, type)
+
+
+# ------------------------------------
+# Misc Functions
+# ------------------------------------
+def bin_intervals(starts, ends, values, boundaries, coverage=None) -> tuple:
+    """Covered bases & sum of values between boundaries
+
+starts, ends & values are sorted non-overlapping intervals. The integral of
+value & coverage at each boundary is computed with cumulative sums, so each
+bin is the difference of integrals at its two boundaries. coverage is the
+fraction of covered bases of each interval, 1 if not given.
+"""
+    lengths = ends - starts
+    if coverage is None:
+        cum_valid = np.concatenate([[0], np.cumsum(lengths)]).astype(
+            np.float64)
+    else:
+        cum_valid = np.concatenate([[0.0], np.cumsum(lengths * coverage)])
+    cum_sums = np.concatenate([[0.0], np.cumsum(lengths * values)])
+
+    # intervals ended before boundary, plus partial one covers the boundary
+    n = np.searchsorted(ends, boundaries, side='right')
+    partial = np.zeros(len(boundaries), dtype=np.float64)
+    has_next = n < len(starts)
+    next_index = n[has_next]
+    partial[has_next] = np.maximum(
+        boundaries[has_next] - starts[next_index], 0)
+    valid_at = cum_valid[n]
+    if coverage is None:
+        valid_at += partial
+    else:
+        valid_at[has_next] += partial[has_next] * coverage[next_index]
+    sums_at = cum_sums[n]
+    sums_at[has_next] += partial[has_next] * values[next_index]
+    return np.diff(valid_at), np.diff(sums_at)
+
+
+def summary_values(valid, sums, bin_size: float, type: str = 'mean'):
+    """Mean value or coverage from covered bases & sum of values"""
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if type == 'mean':
+            result = sums / valid
+        elif type == 'coverage':
+            result = valid / bin_size
+        else:
+            raise ValueError(f'Unknown summary type: {type}.')
+    result[valid <= 0] = np.nan
+    return result
@@ -4,104 +4,363 @@
 # Import Modules
 # ------------------------------
 import os, sys
+import re
+import time
+import gzip
+import mmap
+import json
+import hashlib
+import shutil
 from optparse import OptionParser
-import subprocess
-from multiprocessing import cpu_count
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import cpu_count, get_context
+import numpy as np
+from bigWigReader import BigWigFile, summary_values
+
+# ------------------------------
+# Constants
+# ------------------------------
+CACHE_DIR = os.path.join('~', '.cache', 'getBigWigValue')
+CACHE_SIZE = 2048  # MB
+CHUNK_REGIONS = 10000  # regions per task at most, also progress granularity
+# only files written by result_cache_file & save_cached_values are evicted
+CACHE_FILE_PATTERN = re.compile(r'^[0-9a-f]{40}\.npy$')
+CACHE_TEMP_PATTERN = re.compile(r'^[0-9a-f]{40}\.npy\.\d+\.tmp$')
+CACHE_TEMP_AGE = 3600  # seconds, older temp files are left by crashed runs
+# I/O counters of BigWigFile reported by workers
+COUNTERS = ['bytes_read', 'read_seconds', 'bytes_decompressed', 'cache_hits',
+            'cache_misses']
 
 # ------------------------------
 # Sub process
 # ------------------------------
-signal_capture = '''#! /usr/bin/env python3
-import os, sys
-import subprocess
-from distutils.spawn import find_executable
-
-script_name = os.path.basename(sys.argv[0])
-USAGE = f'{script_name} <name> <bedfile> <datapoints> <strand> <bigwigfiles+>'
-
-datapoints = int(sys.argv[3])
-strand_specific = int(sys.argv[4])
-bwfhds = [x for x in sys.argv[5:]]
-
-rfhds = [
-    open(sys.argv[1] + '_siteprof' + str(i + 1), 'w')
-    for i in range(len(bwfhds))
-]
-bed = {}
-with open(sys.argv[2]) as bedFhd:
-    for line in bedFhd:
-        line = line.strip().split()
-        chrom, start, end = line[0], int(line[1]), int(line[2])
-        if strand_specific:
-            strand = line[5]
-        for i in range(len(bwfhds)):
-            sp = subprocess.Popen([
-                f'{find_executable("bigWigSummary")}'
-                if find_executable("bigWigSummary") else '../bigWigSummary',
-                f'{bwfhds[i]}', f'{chrom}', f'{max(0, start)}', f'{end}',
-                f'{datapoints}'
-            ],
-                                  stdout=subprocess.PIPE,
-                                  stderr=subprocess.PIPE,
-                                  encoding='utf-8')
-            out, err = sp.communicate()
-            if out:
-                output_values = [
-                    '0' if value == 'n/a' else value
-                    for value in out.strip().split()
-                ]
-            else:
-                output_values = ['0' for datapoint in range(datapoints)]
+def capture_matrix(regions, bigwigs, datapoints, strand_specific,
+                   value_types, exact=True):
+    '''Capture value_types (mean and/or coverage) of regions from opened
+    bigwigs. regions are (chrom, strand, segments) tuples, segments are
+    (start, end, bins) windows in genomic order, whose bins are concatenated
+    to datapoints columns. All value types are computed from the same decoded
+    data of each window, which is zoom level summary records for wide bins
+    unless exact is set. Return array of shape (value_types, bigwigs, regions,
+    datapoints), bins without data are 0.
+    '''
+    matrix = np.zeros((len(value_types), len(bigwigs), len(regions),
+                       datapoints))
+    for j, (chrom, strand, segments) in enumerate(regions):
+        for i, bigwig in enumerate(bigwigs):
+            column = 0
+            for start, end, bins in segments:
+                valid, sums = bigwig.summarize(chrom, start, end, bins, exact)
+                for k, value_type in enumerate(value_types):
+                    values = summary_values(valid, sums, (end - start) / bins,
+                                            value_type)
+                    matrix[k, i, j, column:column + bins] = np.nan_to_num(
+                        values, nan=0)
+                column += bins
             if strand_specific and strand == '-':
-                output_values.reverse()
-            rfhds[i].write('\\t'.join(output_values) + '\\n')
-'''
+                matrix[:, i, j] = matrix[:, i, j, ::-1]
+    return matrix
 
-coverageCapture = '''#! /usr/bin/env python3
-import os, sys
-import subprocess
-from distutils.spawn import find_executable
-
-script_name = os.path.basename(sys.argv[0])
-USAGE = f'{script_name} <name> <bedfile> <datapoints> <strand> <bigwigfiles+>'
-
-datapoints = int(sys.argv[3])
-strand_specific = int(sys.argv[4])
-bwfhds = [x for x in sys.argv[5:]]
-
-rfhds = [
-    open(sys.argv[1] + '_siteprof' + str(i + 1), 'w')
-    for i in range(len(bwfhds))
-]
-bed = {}
-with open(sys.argv[2]) as bedFhd:
-    for line in bedFhd:
+
+def load_regions(bed_lines, strand_specific, datapoints):
+    '''Regions of bed_lines, each split into datapoints bins'''
+    regions = []
+    for line in bed_lines:
         line = line.strip().split()
-        chrom, start, end = line[0], int(line[1]), int(line[2])
-        if strand_specific:
-            strand = line[5]
-        for i in range(len(bwfhds)):
-            sp = subprocess.Popen([
-                f'{find_executable("bigWigSummary")}'
-                if find_executable("bigWigSummary") else '../bigWigSummary',
-                '-type=coverage', f'{bwfhds[i]}', f'{chrom}',
-                f'{max(0, start)}', f'{end}', f'{datapoints}'
-            ],
-                                  stdout=subprocess.PIPE,
-                                  stderr=subprocess.PIPE,
-                                  encoding='utf-8')
-            out, err = sp.communicate()
-            if out:
-                output_values = [
-                    '0' if value == 'n/a' else value
-                    for value in out.strip().split()
-                ]
-            else:
-                output_values = ['0' for datapoint in range(datapoints)]
-            if strand_specific and strand == '-':
-                output_values.reverse()
-            rfhds[i].write('\\t'.join(output_values) + '\\n')
-'''
+        strand = line[5] if strand_specific else '+'
+        regions.append((line[0], strand,
+                        ((max(0, int(line[1])), int(line[2]), datapoints), )))
+    return regions
+
+
+def read_feature(line, region_format):
+    '''(chrom, start, end, strand) of a BED6 or genePredExt line, BED lines
+    without strand are on + strand.
+    '''
+    line = line.strip().split()
+    if region_format == 'genePredExt':
+        return line[1], int(line[3]), int(line[4]), line[2]
+    strand = line[5] if len(line) > 5 else '+'
+    return line[0], int(line[1]), int(line[2]), strand
+
+
+def profile_segments(start, end, strand, options):
+    '''Windows of a feature in reference-point or scale-regions mode, as
+    (start, end, bins) in genomic order. Flanks are upstream & downstream of
+    the feature strand, so output is in 5' to 3' order after the row of -
+    strand features is reversed.
+    '''
+    left, right = options.upstream, options.downstream
+    if strand == '-':
+        left, right = right, left
+    if options.mode == 'reference-point':
+        if options.referencePoint == 'center':
+            point = (start + end) // 2
+        elif (options.referencePoint == 'TSS') == (strand != '-'):
+            point = start
+        else:
+            point = end
+        return ((point - left, point + right, options.datapoints), )
+    left_bins = options.flankDatapoints if left else 0
+    right_bins = options.flankDatapoints if right else 0
+    segments = [(start - left, start, left_bins),
+                (start, end, options.datapoints),
+                (end, end + right, right_bins)]
+    return tuple(segment for segment in segments if segment[2] > 0)
+
+
+def load_profile_regions(lines, options):
+    '''Regions of features in lines for reference-point or scale-regions
+    mode, windows are computed from each feature on the fly.
+    '''
+    regions = []
+    for line in lines:
+        chrom, start, end, strand = read_feature(line, options.regionFormat)
+        regions.append(
+            (chrom, strand, profile_segments(start, end, strand, options)))
+    return regions
+
+
+def region_order(regions):
+    '''Rows of regions sorted by (chrom, start of first window)'''
+    return np.array(sorted(range(len(regions)),
+                           key=lambda row:
+                           (regions[row][0], regions[row][2][0][0])),
+                    dtype=np.int64)
+
+
+def profile_width(options):
+    '''Number of columns of each region'''
+    if options.mode != 'scale-regions':
+        return options.datapoints
+    flanks = bool(options.upstream) + bool(options.downstream)
+    return options.datapoints + flanks * options.flankDatapoints
+
+
+# bigwig handles of this process & capture job shared with forked workers
+_open_bigwigs = {}
+_capture_job = None
+
+
+def get_bigwig(bigwig_file):
+    '''Open bigwig_file once per process. Handles are not shared with forked
+    processes, as file offsets of inherited handles are shared.
+    '''
+    key = (os.getpid(), bigwig_file)
+    if key not in _open_bigwigs:
+        _open_bigwigs[key] = BigWigFile(bigwig_file)
+    return _open_bigwigs[key]
+
+
+def bigwig_counters(bigwigs):
+    '''Sum of I/O COUNTERS of opened bigwigs'''
+    return {
+        name: sum(getattr(bigwig, name) for bigwig in bigwigs)
+        for name in COUNTERS
+    }
+
+
+def capture_range(lo, hi):
+    '''Capture regions order[lo:hi] of _capture_job into its shared matrix.
+    Regions are visited in (chrom, start) order to reuse cached data blocks,
+    and values are scattered back to the original rows. Return counters of
+    this task for progress report.
+    '''
+    (regions, order, matrix, bigwig_files, datapoints, strand_specific,
+     value_types, exact) = _capture_job
+    bigwigs = [get_bigwig(bigwig_file) for bigwig_file in bigwig_files]
+    before = bigwig_counters(bigwigs)
+    start_time = time.perf_counter()
+    rows = order[lo:hi]
+    matrix[:, :, rows] = capture_matrix([regions[row] for row in rows],
+                                        bigwigs, datapoints, strand_specific,
+                                        value_types, exact)
+    stats = {
+        name: value - before[name]
+        for name, value in bigwig_counters(bigwigs).items()
+    }
+    stats.update(pid=os.getpid(),
+                 regions=hi - lo,
+                 seconds=time.perf_counter() - start_time)
+    return stats
+
+
+def capture_pool(regions, bigwig_files, datapoints, strand_specific,
+                 value_types, exact, processes, dtype=np.float64,
+                 progress=None):
+    '''Capture value_types of regions from bigwig_files with a process pool.
+    Regions are sorted by (chrom, start), workers get ranges of the sorted
+    regions and write into a matrix in shared memory at the original rows, so
+    no temp file is written. Counters of each finished range are passed to
+    progress.
+    '''
+    global _capture_job
+    shape = (len(value_types), len(bigwig_files), len(regions), datapoints)
+    size = int(np.prod(shape))
+    # anonymous shared mapping, inherited by forked workers
+    buffer = mmap.mmap(-1, max(1, size * np.dtype(dtype).itemsize))
+    matrix = np.frombuffer(buffer, dtype=dtype, count=size).reshape(shape)
+    order = region_order(regions)
+    _capture_job = (regions, order, matrix, bigwig_files, datapoints,
+                    strand_specific, value_types, exact)
+    chunk_size = max(1, min(len(regions) // (processes * 4), CHUNK_REGIONS))
+    with ProcessPoolExecutor(max_workers=processes,
+                             mp_context=get_context('fork')) as executor:
+        futures = [
+            executor.submit(capture_range, lo, min(lo + chunk_size,
+                                                   len(regions)))
+            for lo in range(0, len(regions), chunk_size)
+        ]
+        for future in as_completed(futures):
+            stats = future.result()
+            if progress is not None:
+                progress.update(stats)
+    _capture_job = None
+    return matrix
+
+
+class CaptureProgress():
+    '''Aggregate counters of finished tasks by worker. A status line of
+    regions/s, decompressed bytes and block cache hit rate is refreshed on
+    stderr if it is a terminal.
+    '''
+
+    def __init__(self, total, processes, interval=0.5):
+        self.total = total
+        self.processes = processes
+        self.interval = interval
+        self.workers = {}
+        self.start_time = time.perf_counter()
+        self.last_report = 0
+        self.show = sys.stderr.isatty()
+
+    def update(self, stats):
+        worker = self.workers.setdefault(
+            stats['pid'], {name: 0
+                           for name in ['regions', 'seconds'] + COUNTERS})
+        for name in worker:
+            worker[name] += stats[name]
+        now = time.perf_counter()
+        if self.show and now - self.last_report >= self.interval:
+            self.last_report = now
+            sys.stderr.write(f'\r{self.status()}')
+            sys.stderr.flush()
+
+    def finish(self):
+        if self.show:
+            sys.stderr.write(f'\r{self.status()}\n')
+
+    def totals(self):
+        totals = {name: 0 for name in ['regions', 'seconds'] + COUNTERS}
+        for worker in self.workers.values():
+            for name in totals:
+                totals[name] += worker[name]
+        return totals
+
+    def status(self):
+        totals = self.totals()
+        elapsed = time.perf_counter() - self.start_time
+        blocks = totals['cache_hits'] + totals['cache_misses']
+        hit_rate = totals['cache_hits'] / blocks if blocks else 0
+        return (f'{totals["regions"]}/{self.total} regions, '
+                f'{totals["regions"] / elapsed:.0f} regions/s, '
+                f'{totals["bytes_decompressed"] / 1024**2:.1f} MB '
+                f'decompressed, block cache hit {hit_rate:.1%}')
+
+    def metrics(self):
+        '''Totals & per worker counters, rates are per second of run time for
+        totals and per busy second for each worker.
+        '''
+        elapsed = time.perf_counter() - self.start_time
+        metrics = self.totals()
+        metrics.update(processes=self.processes,
+                       elapsed_seconds=elapsed,
+                       workers=[])
+        for pid, worker in sorted(self.workers.items()):
+            metrics['workers'].append(dict(pid=pid, **worker))
+        for counters, seconds in [(metrics, elapsed)] + [
+            (worker, worker['seconds']) for worker in metrics['workers']
+        ]:
+            blocks = counters['cache_hits'] + counters['cache_misses']
+            counters['regions_per_second'] = (counters['regions'] / seconds
+                                              if seconds else 0)
+            counters['read_mb_per_second'] = (
+                counters['bytes_read'] / 1024**2 / counters['read_seconds']
+                if counters['read_seconds'] else 0)
+            counters['cache_hit_rate'] = (counters['cache_hits'] / blocks
+                                          if blocks else 0)
+        return metrics
+
+
+# ------------------------------
+# Python API
+# ------------------------------
+class SignalCapture():
+    '''Capture signal of regions from bigWig files in the calling process.
+
+    bigWig files are opened on first use and kept open, once per process, so
+    a SignalCapture can be reused across calls, e.g. in a notebook.
+
+    >>> with SignalCapture(['a.bw', 'b.bw']) as capture:
+    ...     signal = capture.profile([('chr1', 0, 5000, '-')], 10, strand=True)
+    '''
+
+    def __init__(self, bigwig_files, exact=False):
+        self.bigwig_files = [
+            os.path.expanduser(bigwig_file) for bigwig_file in bigwig_files
+        ]
+        self.exact = exact
+        self._bigwigs = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        for bigwigs in self._bigwigs.values():
+            for bigwig in bigwigs:
+                bigwig.close()
+        self._bigwigs = {}
+
+    def bigwigs(self):
+        '''Opened bigWig files of this process'''
+        key = os.getpid()
+        if key not in self._bigwigs:
+            self._bigwigs[key] = [
+                BigWigFile(bigwig_file) for bigwig_file in self.bigwig_files
+            ]
+        return self._bigwigs[key]
+
+    def profile(self, regions, bins=1, strand=False, type='mean',
+                processes=1):
+        '''Profile of regions, each broken into bins equal parts.
+
+        regions : (chrom, start, end) or (chrom, start, end, strand) tuples
+        strand : reverse bins of - strand regions if True
+        type : mean, coverage or a list of them
+        processes : capture with a pool of forked processes if > 1, see
+            capture_pool
+
+        Return array of shape (bigwigs, regions, bins), or (types, bigwigs,
+        regions, bins) if type is a list. Bins without data are 0.
+        '''
+        regions = [(region[0], region[3] if strand else '+',
+                    ((max(0, int(region[1])), int(region[2]), bins), ))
+                   for region in regions]
+        value_types = [type] if isinstance(type, str) else list(type)
+        if processes > 1:
+            matrix = capture_pool(regions, self.bigwig_files, bins, strand,
+                                  value_types, self.exact, processes)
+            return matrix[0] if isinstance(type, str) else matrix
+        order = region_order(regions)
+        matrix = np.zeros(
+            (len(value_types), len(self.bigwig_files), len(regions), bins))
+        matrix[:, :, order] = capture_matrix([regions[row] for row in order],
+                                             self.bigwigs(), bins, strand,
+                                             value_types, self.exact)
+        return matrix[0] if isinstance(type, str) else matrix
 
 
 # ------------------------------
@@ -112,7 +371,7 @@ def prepare_optparser():
     Prepare optparser object. New options will be added in thisfunction first.
     '''
     script_name = os.path.basename(sys.argv[0])
-    usage = f'USAGE: {script_name} <-b bedFile> <-w bigWigFiles+> [-n name] [-p process] [-s datapoints] [-m model]'
+    usage = f'USAGE: {script_name} <-b bedFile> <-w bigWigFiles+> [-n name] [-p process] [-s datapoints] [-m model] [--exact] [-f format] [--mode mode] [-u upstream] [-d downstream] [--cacheDir dir] [--no-cache] [--metrics metrics.json]'
     description = 'bigWigSignalCapture -- Capture signal form bigWigFiles.'
     
     # option processor
@@ -140,6 +399,34 @@ def prepare_optparser():
                          help='Capture model: security or speed. Default is Security',default='security')
     optparser.add_option('--strand',dest='strand', action='store_true',\
                          help='If Strand specific')
+    optparser.add_option('--exact',dest='exact', action='store_true',\
+                         help='Summarize from base level data only. By default, bins at least twice as wide as a zoom level are summarized from the zoom level records of the bigWig, as bigWigSummary does.')
+    optparser.add_option('-f', '--format',dest='format', type='choice', choices=['text', 'npy'],\
+                         help='Output format: text or npy. text: gzipped tab-delimited values. npy: float32 (regions x datapoints) matrix of each bigWig, with {name}_regions.bed as row index. Default is text.',default='text')
+    
+    # profile setting
+    optparser.add_option('--mode',dest='mode', type='choice', choices=['regions', 'reference-point', 'scale-regions'],\
+                         help='Profile mode: regions, reference-point or scale-regions. regions: each region is broken into datapoints bins. reference-point: upstream to downstream of the reference point of each feature is broken into datapoints bins. scale-regions: each feature body is broken into datapoints bins, and each flank into flankDatapoints bins. Profiles of reference-point and scale-regions are strand aware. Default is regions.',default='regions')
+    optparser.add_option('--regionFormat',dest='regionFormat', type='choice', choices=['bed', 'genePredExt'],\
+                         help='Format of features in reference-point and scale-regions mode: bed (BED6, + strand if no 6th column) or genePredExt. Default is bed.',default='bed')
+    optparser.add_option('--referencePoint',dest='referencePoint', type='choice', choices=['TSS', 'TES', 'center'],\
+                         help='Reference point in reference-point mode: TSS, TES or center. Default is TSS.',default='TSS')
+    optparser.add_option('-u', '--upstream',dest='upstream', type='int',\
+                         help='Bases upstream of the reference point or feature start. Default is 1000.',default=1000)
+    optparser.add_option('-d', '--downstream',dest='downstream', type='int',\
+                         help='Bases downstream of the reference point or feature end. Default is 1000.',default=1000)
+    optparser.add_option('--flankDatapoints',dest='flankDatapoints', type='int',\
+                         help='Bins of each flank in scale-regions mode. Default is datapoints.')
+    
+    # cache setting
+    optparser.add_option('--cacheDir',dest='cacheDir', type='string',\
+                         help=f'Directory of cached results, reused when bigWig files, regions and settings are not changed. Default is {CACHE_DIR}.',default=CACHE_DIR)
+    optparser.add_option('--cacheSize',dest='cacheSize', type='int',\
+                         help=f'Size limit of the cache directory in MB, least recently used results are removed first. Default is {CACHE_SIZE}.',default=CACHE_SIZE)
+    optparser.add_option('--no-cache',dest='cache', action='store_false',\
+                         help='Do not use or write cached results. Default is use cache.',default=True)
+    optparser.add_option('--metrics',dest='metrics', type='string',\
+                         help='Write run time, regions/s, bytes read & decompressed and block cache hit rate of each worker to this JSON file at exit.')
     
     return optparser
 
@@ -176,6 +463,31 @@ def opt_validate(optparser):
         optparser.print_help()
         sys.exit(1)
     
+    # check profile setting
+    if options.datapoints < 1:
+        sys.stdout.write('Datapoints must be positive!\n')
+        optparser.print_help()
+        sys.exit(1)
+    if options.upstream < 0 or options.downstream < 0:
+        sys.stdout.write('Upstream and downstream must not be negative!\n')
+        optparser.print_help()
+        sys.exit(1)
+    if options.mode == 'reference-point' and not (options.upstream or
+                                                  options.downstream):
+        sys.stdout.write(
+            'Upstream or downstream must be set in reference-point mode!\n')
+        optparser.print_help()
+        sys.exit(1)
+    if options.flankDatapoints is None:
+        options.flankDatapoints = options.datapoints
+    if options.flankDatapoints < 1:
+        sys.stdout.write('Flank datapoints must be positive!\n')
+        optparser.print_help()
+        sys.exit(1)
+    if options.mode != 'regions':
+        options.strand = True
+    options.cacheDir = os.path.expanduser(options.cacheDir)
+    
     # get name
     if not options.name:
         options.name = f'bigWigSignalCapture_{time.strftime("%Y.%b.%d.%H-%M-%S", time.localtime())}'
@@ -183,100 +495,143 @@ def opt_validate(optparser):
     return options
 
 
-def load_bed(bedFile):
-    with open(bedFile) as fhd:
-        bed = [line for line in fhd]
-    return bed
+def capture_values(options, regions, value_types, progress=None):
+    '''Capture value_types of regions from options.bigWigFiles with a process
+    pool, see capture_pool. Counters of each finished range are passed to
+    progress.
+    '''
+    dtype = np.float32 if options.format == 'npy' else np.float64
+    return capture_pool(regions, options.bigWigFiles, profile_width(options),
+                        options.strand, value_types, options.exact,
+                        options.process, dtype, progress)
 
 
-def prepare_capture(options):
-    # check subprocess file
-    with open('signalCapture.py', 'w') as fhd:
-        fhd.write(signal_capture)
-    with open('coverageCapture.py', 'w') as fhd:
-        fhd.write(coverageCapture)
-    os.system('chmod 755 signalCapture.py coverageCapture.py')
-    
-    bed = load_bed(options.bedFile)
-    # creat temp dirctory
-    CMD = f'mkdir {options.name} && cd {options.name}\n'
-    for i in range(len(options.bigWigFiles)):
-        if options.bigWigFiles[i].startswith('/'):
-            CMD += f'ln -s {options.bigWigFiles[i]} .\n'
-        else:
-            CMD += f'ln -s ../{options.bigWigFiles[i]} .\n'
-    os.system(CMD)
-    # write temp bed files
-    sub_sizes = int(len(bed) / options.process)
-    sub_index = []
-    for i in range(options.process - 1):
-        sub_index.append((i * sub_sizes, i * sub_sizes + sub_sizes))
-    sub_index.append((options.process * sub_sizes - sub_sizes, len(bed)))
-    for i in range(options.process):
-        with open(f'{options.name}/temp_{options.name}_{i+1}.bed', 'w') as fhd:
-            fhd.write(''.join(bed[sub_index[i][0]:sub_index[i][1]]))
+def result_cache_file(options, bed_data, value_types):
+    '''Cache file of a run, named by hash of size & modify time of bigWig
+    files, regions and all settings changing the captured matrix.
+    '''
+    digest = hashlib.sha1()
+    for bigwig_file in options.bigWigFiles:
+        stat = os.stat(bigwig_file)
+        digest.update(f'{os.path.abspath(bigwig_file)}\t{stat.st_size}\t'
+                      f'{stat.st_mtime_ns}\n'.encode())
+    digest.update(hashlib.sha1(bed_data).digest())
+    setting = (value_types, options.format, options.datapoints,
+               bool(options.strand), bool(options.exact), options.mode,
+               options.regionFormat, options.referencePoint, options.upstream,
+               options.downstream, options.flankDatapoints)
+    digest.update(repr(setting).encode())
+    return os.path.join(options.cacheDir, f'{digest.hexdigest()}.npy')
 
 
-def capture_signal(options):
-    strand_parameter = 1 if options.strand else 0
-    bw_files_parameter = ' '.join(
-        os.path.basename(filename) for filename in options.bigWigFiles)
-    # Caputre signal
-    processes = []
-    for i in range(options.process):
-        CMD = f'cd {options.name} && python3 ../signalCapture.py temp_signal_{options.name}_{i+1} temp_{options.name}_{i+1}.bed {options.datapoints} {strand_parameter} {bw_files_parameter}'
-        # print('Sub Command: ', CMD)
-        processes.append(subprocess.Popen(CMD, shell=True))
-    stats = []
-    for i in range(options.process):
-        stats.append(os.waitpid(processes[i].pid, 0))
-    CMD = ''
-    for i in range(len(options.bigWigFiles)):
-        CMD += 'cat '
-        for j in range(options.process):
-            CMD += f'{options.name}/temp_signal_{options.name}_{j+1}_siteprof{i+1} '
-        CMD += f'| gzip - > signal_{options.name}_siteprof{i+1}.gz && \\\n'
-    CMD = CMD[:-5]
-    with open('tem.sh', 'w') as fhd:
-        fhd.write(CMD)
-    # print('Cat Command: ', CMD)
-    p = subprocess.Popen('bash tem.sh', shell=True)
+def load_cached_values(cache_file):
+    '''Cached matrix, None if missing. Modify time of a hit is updated, so
+    it is the last used time for eviction.
+    '''
+    if not os.path.isfile(cache_file):
+        return None
     try:
-        os.waitpid(p.pid, 0)
-    except OSError:
-        pass
-    # Coverage capture
-    if options.model == 'security':
-        processes = []
-        for i in range(options.process):
-            CMD = f'cd {options.name} && python3 ../coverageCapture.py temp_coverage_{options.name}_{i+1} temp_{options.name}_{i+1}.bed {options.datapoints} {strand_parameter} {bw_files_parameter}'
-            # print('Sub Command: ', CMD)
-            processes.append(subprocess.Popen(CMD, shell=True))
-        stats = []
-        for i in range(options.process):
-            stats.append(os.waitpid(processes[i].pid, 0))
-        CMD = ''
-        for i in range(len(options.bigWigFiles)):
-            CMD += 'cat '
-            for j in range(options.process):
-                CMD += f'{options.name}/temp_coverage_{options.name}_{j+1}_siteprof{i+1} '
-            CMD += f'| gzip - > coverage_{options.name}_siteprof{i+1}.gz && \\\n'
-        CMD = CMD[:-5]
-        with open('tem.sh', 'w') as fhd:
-            fhd.write(CMD)
-        # print('Cat Command: ', CMD)
-        p = subprocess.Popen('bash tem.sh', shell=True)
+        matrix = np.load(cache_file, mmap_mode='r')
+        os.utime(cache_file)
+    except (OSError, ValueError):  # removed by other runs or broken
+        return None
+    return matrix
+
+
+def save_cached_values(cache_file, matrix, cache_size):
+    '''Save matrix to cache, then remove least recently used results until
+    the cache directory is under cache_size MB.
+    '''
+    if matrix.nbytes > cache_size * 1024**2:
+        return
+    # write to a temp file first, other runs never see a partial cache
+    temp_file = f'{cache_file}.{os.getpid()}.tmp'
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        with open(temp_file, 'wb') as fhd:
+            np.save(fhd, matrix)
+        os.replace(temp_file, cache_file)
+        evict_cache(os.path.dirname(cache_file), cache_size)
+    except OSError:  # cache directory is not writable, skip caching
+        if os.path.isfile(temp_file):
+            os.remove(temp_file)
+
+
+def evict_cache(cache_dir, cache_size):
+    '''Remove least recently used cache files until cache_dir is under
+    cache_size MB, and temp files of crashed runs. Other files in cache_dir
+    are never touched.
+    '''
+    entries = []
+    for file_name in os.listdir(cache_dir):
+        is_cache = CACHE_FILE_PATTERN.match(file_name)
+        if not is_cache and not CACHE_TEMP_PATTERN.match(file_name):
+            continue
         try:
-            os.waitpid(p.pid, 0)
+            stat = os.stat(os.path.join(cache_dir, file_name))
+            if not is_cache:
+                if time.time() - stat.st_mtime > CACHE_TEMP_AGE:
+                    os.remove(os.path.join(cache_dir, file_name))
+                continue
+        except OSError:
+            continue
+        entries.append((stat.st_mtime_ns, stat.st_size, file_name))
+    total = sum(size for _, size, _ in entries)
+    for _, size, file_name in sorted(entries):
+        if total <= cache_size * 1024**2:
+            break
+        try:
+            os.remove(os.path.join(cache_dir, file_name))
         except OSError:
             pass
-    p = subprocess.Popen(
-        f'rm -r {options.name} tem.sh signalCapture.py coverageCapture.py',
-        shell=True)
-    try:
-        os.waitpid(p.pid, 0)
-    except OSError:
-        pass
+        total -= size
+
+
+def write_values(options, label, matrix):
+    for i in range(len(options.bigWigFiles)):
+        if options.format == 'npy':
+            np.save(f'{label}_{options.name}_siteprof{i+1}.npy', matrix[i])
+            continue
+        with gzip.open(f'{label}_{options.name}_siteprof{i+1}.gz',
+                       'wt') as fhd:
+            for values in matrix[i]:
+                fhd.write('\t'.join('0' if value == 0 else f'{value:g}'
+                                    for value in values) + '\n')
+
+
+def capture_signal(options):
+    with open(options.bedFile, 'rb') as fhd:
+        bed_data = fhd.read()
+    # Caputre signal, and coverage in the same pass in security model
+    value_types = ['mean', 'coverage'] if options.model == 'security' else [
+        'mean'
+    ]
+    matrix = None
+    if options.cache:
+        cache_file = result_cache_file(options, bed_data, value_types)
+        matrix = load_cached_values(cache_file)
+    cached = matrix is not None
+    progress = CaptureProgress(0, options.process)
+    if not cached:
+        lines = bed_data.decode().splitlines()
+        if options.mode == 'regions':
+            regions = load_regions(lines, options.strand, options.datapoints)
+        else:
+            regions = load_profile_regions(lines, options)
+        progress.total = len(regions)
+        matrix = capture_values(options, regions, value_types, progress)
+        progress.finish()
+        if options.cache:
+            save_cached_values(cache_file, matrix, options.cacheSize)
+    if options.metrics:
+        with open(options.metrics, 'w') as fhd:
+            json.dump(dict(progress.metrics(), cached=cached), fhd, indent=2)
+    write_values(options, 'signal', matrix[0])
+    if options.model == 'security':
+        write_values(options, 'coverage', matrix[1])
+    # region index of npy rows
+    if options.format == 'npy':
+        shutil.copyfile(options.bedFile, f'{options.name}_regions.bed')
 
 
 # ------------------------------
@@ -287,9 +642,6 @@ def main():
     # read the options and validate them
     options = opt_validate(prepare_optparser())
     
-    # prepare capture
-    prepare_capture(options)
-    
     # capture signal
     capture_signal(options)
 
@@ -302,5 +654,5 @@ if __name__ == '__main__':
     try:
         main()
     except KeyboardInterrupt:
-        Info('User interrupts me! ;-) See you!')
+        sys.stdout.write('User interrupts me! ;-) See you!\n')
         sys.exit(0)
@@ -2,9 +2,10 @@
 
 import os
 import sys
-from collections import defaultdict
 
 from numpy import nanmean
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'DNAme'))
+from methylation_store import load_meth
 
 self_name = sys.argv[0]
 USAGE = f'{self_name} <name> <tssFile> <methylationFile> <span> <window> <step>'
@@ -29,11 +30,9 @@ def getMethylationInfo(tss, methylation, span, window, step):
     methylatedCpG = []
     mediumCpG = []
     for i in range(int(2*(span-window/2)/step+1)):
-        local_methylation = []
-        for j in range(window+1):
-            if pos-span+i*step+j-1 in methylation[chrom]:
-                local_methylation.append(methylation[chrom][pos-span+i*step+j-1])
-        if len(local_methylation) == 0:
+        window_start = pos-span+i*step-1
+        positions, ratio, total, meth = methylation.region(chrom, window_start, window_start+window+1)
+        if len(positions) == 0:
             coverage.append(float("nan"))
             CpGnumber.append(0)
             methylation_level.append(float("nan"))
@@ -41,25 +40,19 @@ def getMethylationInfo(tss, methylation, span, window, step):
             methylatedCpG.append(float("nan"))
             mediumCpG.append(float("nan"))
         else:
-            coverage.append(nanmean([m[1] for m in local_methylation]))
-            CpGnumber.append(len(local_methylation))
-            methylation_level.append(1.0*sum([m[2] for m in local_methylation])/sum([m[1] for m in local_methylation]))
-            unmethylatedCpG.append(sum(1 for m in local_methylation if m[0]<=0.2))
-            methylatedCpG.append(sum(1 for m in local_methylation if m[0]>0.8))
-            mediumCpG.append(sum(1 for m in local_methylation if m[0]<=0.8 and m[0]>0.2))
+            coverage.append(nanmean(total))
+            CpGnumber.append(len(positions))
+            methylation_level.append(1.0*int(meth.sum())/int(total.sum()))
+            unmethylatedCpG.append(int((ratio<=0.2).sum()))
+            methylatedCpG.append(int((ratio>0.8).sum()))
+            mediumCpG.append(int(((ratio<=0.8) & (ratio>0.2)).sum()))
 
     return (methylation_level, unmethylatedCpG, coverage, CpGnumber, methylatedCpG, mediumCpG)
 
 
 
-methylation = defaultdict(dict)
-with open(methylationFile) as methylationFhd:
-    for line in methylationFhd:
-        if line[0] == "#" or not line:
-            continue
-        line = line.strip().split()
-        methylation[line[0]][int(line[1])] = (float(line[3]), int(line[4]), int(line[5]))
-    methylationFhd.close()
+# chrom, pos, ratio, totalC & methC are used, trimmed files are accepted
+methylation = load_meth(methylationFile, min_columns=6)
 
 
 with open(                             tssFile ) as     tssFhd, \
@@ -16,6 +16,9 @@ mpl.rcParams['font.sans-serif'] = 'Helvetica'
 import matplotlib.pyplot as plt
 import seaborn as sns
 from itertools import combinations
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from getBigWigValue import SignalCapture
 
 # ------------------------------------
 # Constant
@@ -118,36 +121,26 @@ def get_bigwig_files(samples):
 
 def avg_bed_signale_capture(name, target_regions_file, bigwig_files, labels, parallel_num=8):
     """
-    perform bigWigAverageOverBed for given target_regions_file and bigwi_files
+    capture mean0 (sum over region size, as bigWigAverageOverBed) of target_regions_file for each bigwig file
     """
-    cmd = f'cut -f 1-4 {target_regions_file} > captures_regions.bed'
-    subprocess.call(cmd, shell=True)
-    cmd = ''
-    for index, (label, bigwig_file) in enumerate(zip(labels, bigwig_files)):
-        bw_scan_cmd = f'bigWigAverageOverBed {bigwig_file} captures_regions.bed {label}_signal.tsv &\n'
-        cmd += bw_scan_cmd
-        if (index + 1) % 8 == 0:
-            cmd += 'wait\n'
-    cmd += 'wait\n'
-    with open('tmp.sh', 'w') as fhd:
-        fhd.write(cmd)
-    subprocess.call('bash tmp.sh'.split())
-
-
-def process_signal(name, target_regions_file, bigwig_files, labels):
+    capture_regions = pd.read_csv(target_regions_file, sep='\t', header=None)
+    regions = capture_regions[[0, 1, 2]].itertuples(index=False)
+    with SignalCapture(bigwig_files, exact=True) as capture:
+        mean, coverage = capture.profile(regions,
+                                         type=['mean', 'coverage'],
+                                         processes=parallel_num)
+    return pd.DataFrame((mean * coverage)[:, :, 0].T,
+                        index=capture_regions[3].to_list(),
+                        columns=labels)
+
+
+def process_signal(name, capture_signal, bigwig_files, labels):
     """
     process the captured signal
     """
-    capture_regions = pd.read_csv(target_regions_file, sep='\t', header=None)
-    capture_signal = pd.DataFrame(index=capture_regions[3].to_list())
     for label, bigwig_file in zip(labels, bigwig_files):
         avg = get_bigwig_mean(bigwig_file)
-        capture_signal[label] = pd.read_csv(
-            f'{label}_signal.tsv',
-            sep='\t',
-            header=None,
-            index_col=0,
-            names=['size', 'covered', 'sum', 'mean0', 'mean'])['mean0'] / avg
+        capture_signal[label] = capture_signal[label] / avg
     corr = capture_signal.corr()
     print(f'Correlation is:\n{corr}')
     corr_3 = {}
@@ -188,12 +181,12 @@ def main():
     os.chdir('replicates_quality_check')
     for condition, samples in replicates.items():
         bigwig_files = get_bigwig_files(samples)
-        avg_bed_signale_capture(condition, genome_bin_file, bigwig_files,
-                                samples)
-        process_signal(condition, genome_bin_file, bigwig_files, samples)
-        avg_bed_signale_capture(condition, tss_3000_file, bigwig_files,
-                                samples)
-        process_signal(condition, tss_3000_file, bigwig_files, samples)
+        capture_signal = avg_bed_signale_capture(condition, genome_bin_file,
+                                                 bigwig_files, samples)
+        process_signal(condition, capture_signal, bigwig_files, samples)
+        capture_signal = avg_bed_signale_capture(condition, tss_3000_file,
+                                                 bigwig_files, samples)
+        process_signal(condition, capture_signal, bigwig_files, samples)
     os.chdir('../')
 
 